@@ -0,0 +1,259 @@
+"""Переключение лидера между двумя процессами на общей SQLite.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.failover --ttl 3 --interval 1
+
+Запускает две реплики (отдельные процессы с LeaderElection) на временной БД, ждет, пока одна
+станет лидером, убивает ее через SIGKILL и замеряет, через сколько секунд лидером станет вторая.
+Затем то же для штатной остановки (SIGTERM), при которой аренда отдается сразу. Код возврата 0,
+если обе реплики никогда не были лидерами одновременно и переключение уложилось в ttl + 2 * interval.
+
+После этого поднимаются две реплики самого бота (main.py с FakeBot и LEADER_ELECTION_ENABLED):
+ведомой присылаются мемы через handle_media, и проверяется, что они сохранены в БД, а лидер
+подхватил их по ревизии очереди и запланировал.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from leader import LeaderElection
+from storage import Storage
+
+
+UPLOADS = 3
+
+
+def emit(event: str, replica_id: str, **fields) -> None:
+    print(json.dumps({'event': event, 'replica': replica_id, 'ts': time.time(), **fields}), flush=True)
+
+
+async def worker(db_path: str, replica_id: str, ttl: float, interval: float) -> None:
+    storage = Storage(db_path)
+    await storage.execute("CREATE TABLE IF NOT EXISTS bot_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    async def on_elected():
+        emit('elected', replica_id)
+
+    async def on_demoted():
+        emit('demoted', replica_id)
+
+    election = LeaderElection(storage, replica_id, ttl=ttl, interval=interval,
+                              on_elected=on_elected, on_demoted=on_demoted)
+    stopped = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+    election.start()
+    emit('started', replica_id)
+    await stopped.wait()
+    # Отмечаем до освобождения аренды: после него лидером может стать другая реплика.
+    emit('stopping', replica_id)
+    await election.stop()
+    emit('stopped', replica_id)
+    await storage.close()
+
+
+async def bot_worker(db_path: str, replica_id: str, ttl: float, interval: float) -> None:
+    """Реплика бота на FakeBot; команды из stdin: 'upload N' - прислать N мемов, 'plan' - размер плана."""
+    import main
+    from benchmarks.fakes import ADMIN_USER, FakeBot, callback_update, media_update
+
+    channel = main.Channel("-1001000000000", "Реплики")
+    main.CHANNELS = [channel]
+    main.CHANNELS_BY_ID = {channel.chat_id: channel}
+    main.ALLOWED_USER_IDS.append(ADMIN_USER['id'])
+    main.db = Storage(db_path)
+    main.LEADER_ELECTION_ENABLED = True
+    main.BOT_MODE = 'webhook'
+    main.REPLICA_ID = replica_id
+    main.LEADER_LEASE_TTL = ttl
+    main.LEADER_HEARTBEAT_INTERVAL = interval
+    main.QUEUE_REVISION_CHECK_INTERVAL = interval
+    main.MEDIA_GROUP_DEBOUNCE = 0.1
+    main.bot_startup_time = datetime.now(main.MOSCOW_TZ)
+
+    bot = FakeBot()
+    application = main.build_application(bot=bot)
+    await application.initialize()
+    await main.post_init(application)
+    on_elected = main.leader_election.on_elected
+
+    async def report_elected():
+        await on_elected()
+        emit('elected', replica_id)
+
+    main.leader_election.on_elected = report_elected
+    await application.start()
+    emit('started', replica_id)
+    uploads = 0
+    while True:
+        command = (await asyncio.to_thread(sys.stdin.readline)).split()
+        if not command or command[0] == 'stop':
+            break
+        if command[0] == 'upload':
+            await application.update_queue.put(callback_update(bot, "normal_post"))
+            for _ in range(int(command[1])):
+                uploads += 1
+                await application.update_queue.put(media_update(bot, f"{replica_id}_upload_{uploads}"))
+            await application.update_queue.join()
+            await asyncio.sleep(main.MEDIA_GROUP_DEBOUNCE * 5)
+            row = await main.db.fetchone("SELECT COUNT(*) FROM meme_queue")
+            pending = application.user_data[ADMIN_USER['id']].get('pending_posts', [])
+            emit('uploaded', replica_id, queued=row[0], pending=len(pending))
+        elif command[0] == 'plan':
+            emit('plan', replica_id, jobs=len(main.scheduler_for(channel.chat_id).plan), leader=main.is_leader())
+    await application.stop()
+    await main.post_shutdown(application)
+    await application.shutdown()
+
+
+class Replica:
+    def __init__(self, replica_id: str, process: asyncio.subprocess.Process):
+        self.replica_id = replica_id
+        self.process = process
+        self.events: list[dict] = []
+
+    @classmethod
+    async def spawn(cls, replica_id: str, db_path: str, ttl: float, interval: float, bot: bool = False) -> 'Replica':
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'benchmarks.failover', '--worker', db_path, '--replica-id', replica_id,
+            '--ttl', str(ttl), '--interval', str(interval), *(['--bot'] if bot else []),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        )
+        replica = cls(replica_id, process)
+        await replica.wait_for('started', timeout=10)
+        return replica
+
+    async def send(self, command: str, reply: str, timeout: float) -> dict | None:
+        self.process.stdin.write(f"{command}\n".encode())
+        await self.process.stdin.drain()
+        return await self.wait_for(reply, timeout)
+
+    async def wait_for(self, event: str, timeout: float) -> dict | None:
+        try:
+            async with asyncio.timeout(timeout):
+                while True:
+                    line = await self.process.stdout.readline()
+                    if not line:
+                        return None
+                    self.events.append(json.loads(line))
+                    if self.events[-1]['event'] == event:
+                        return self.events[-1]
+        except TimeoutError:
+            return None
+
+
+def overlaps(replicas: list[Replica]) -> int:
+    """Сколько раз две реплики одновременно считали себя лидерами, по событиям их логов."""
+    timeline = sorted((event['ts'], event['event'], replica.replica_id)
+                      for replica in replicas for event in replica.events
+                      if event['event'] in ('elected', 'demoted', 'stopping', 'killed'))
+    leaders, conflicts = set(), 0
+    for _, event, replica_id in timeline:
+        if event == 'elected':
+            conflicts += bool(leaders - {replica_id})
+            leaders.add(replica_id)
+        else:
+            leaders.discard(replica_id)
+    return conflicts
+
+
+async def run(ttl: float, interval: float) -> dict:
+    budget = ttl + 2 * interval
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = os.path.join(workdir, 'failover.db')
+        first = await Replica.spawn('a', db_path, ttl, interval)
+        replicas = [first]
+        try:
+            if not await first.wait_for('elected', timeout=budget):
+                raise RuntimeError("Первая реплика не стала лидером.")
+            second = await Replica.spawn('b', db_path, ttl, interval)
+            replicas.append(second)
+            results['second_stayed_follower'] = await second.wait_for('elected', timeout=2 * interval) is None
+
+            first.process.kill()
+            killed_at = time.time()
+            await first.process.wait()
+            first.events.append({'event': 'killed', 'replica': 'a', 'ts': killed_at})
+            elected = await second.wait_for('elected', timeout=budget + interval)
+            results['failover_after_kill_s'] = round(elected['ts'] - killed_at, 3) if elected else None
+
+            third = await Replica.spawn('c', db_path, ttl, interval)
+            replicas.append(third)
+            second.process.terminate()
+            terminated_at = time.time()
+            await second.wait_for('stopped', timeout=budget)
+            elected = await third.wait_for('elected', timeout=budget + interval)
+            results['failover_after_sigterm_s'] = round(elected['ts'] - terminated_at, 3) if elected else None
+        finally:
+            for replica in replicas:
+                if replica.process.returncode is None:
+                    replica.process.kill()
+                    await replica.process.wait()
+    results['leader_overlaps'] = overlaps(replicas)
+    results.update(await run_bots(ttl, interval))
+    return {'ttl_s': ttl, 'interval_s': interval, 'budget_s': budget, **results}
+
+
+async def run_bots(ttl: float, interval: float) -> dict:
+    """Мемы, присланные ведомой реплике, сохраняются в БД и попадают в план лидера."""
+    budget = ttl + 2 * interval
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = os.path.join(workdir, 'bots.db')
+        leader = await Replica.spawn('bot_a', db_path, ttl, interval, bot=True)
+        replicas = [leader]
+        try:
+            if not await leader.wait_for('elected', timeout=budget):
+                raise RuntimeError("Реплика бота не стала лидером.")
+            follower = await Replica.spawn('bot_b', db_path, ttl, interval, bot=True)
+            replicas.append(follower)
+            uploaded = await follower.send(f"upload {UPLOADS}", 'uploaded', timeout=budget)
+            results['follower_upload_queued'] = uploaded and uploaded['queued']
+            results['follower_upload_pending'] = uploaded and uploaded['pending']
+            # Лидер замечает новую ревизию очереди за один-два периода проверки.
+            await asyncio.sleep(3 * interval)
+            plan = await leader.send("plan", 'plan', timeout=budget)
+            results['leader_planned_follower_uploads'] = plan and plan['jobs']
+            for replica in replicas:
+                await replica.send("stop", 'never', timeout=budget)
+        finally:
+            for replica in replicas:
+                if replica.process.returncode is None:
+                    replica.process.kill()
+                await replica.process.wait()
+    return results
+
+
+def cli(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Проверка переключения лидера между двумя процессами.")
+    parser.add_argument('--ttl', type=float, default=3.0, help="Время жизни аренды, с")
+    parser.add_argument('--interval', type=float, default=1.0, help="Период продления аренды, с")
+    parser.add_argument('--worker', metavar='DB', help=argparse.SUPPRESS)
+    parser.add_argument('--replica-id', help=argparse.SUPPRESS)
+    parser.add_argument('--bot', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    logging.disable(logging.WARNING)
+    if args.worker:
+        run_worker = bot_worker if args.bot else worker
+        asyncio.run(run_worker(args.worker, args.replica_id, args.ttl, args.interval))
+        return 0
+    report = asyncio.run(run(args.ttl, args.interval))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    ok = (report['second_stayed_follower'] and not report['leader_overlaps']
+          and report['follower_upload_queued'] == UPLOADS and report['follower_upload_pending'] == 0
+          and report['leader_planned_follower_uploads'] == UPLOADS
+          and all(report[key] is not None and report[key] <= report['budget_s']
+                  for key in ('failover_after_kill_s', 'failover_after_sigterm_s')))
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
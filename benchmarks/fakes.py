@@ -0,0 +1,105 @@
+"""Заглушки для офлайн-бенчмарков: Bot без сети и управляемые часы."""
+import asyncio
+import itertools
+import time
+from datetime import datetime
+
+from telegram import Update
+from telegram.ext import ExtBot
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'BenchBot', 'username': 'bench_bot'}
+ADMIN_USER = {'id': 1000, 'is_bot': False, 'first_name': 'Admin'}
+
+
+class FakeBot(ExtBot):
+    """ExtBot, который не ходит в сеть: на каждый вызов Bot API отвечает правдоподобным JSON."""
+
+    __slots__ = ('latency', 'calls', '_message_ids')
+
+    def __init__(self, token: str = "1:bench", latency: float = 0.0):
+        super().__init__(token)
+        with self._unfrozen():
+            self.latency = latency
+            self.calls: list[str] = []
+            self._message_ids = itertools.count(1)
+
+    def _message(self, chat_id) -> dict:
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'from': BOT_USER,
+            'photo': [{'file_id': 'bench_file', 'file_unique_id': 'bench_unique', 'width': 1, 'height': 1}],
+        }
+
+    async def _do_post(self, endpoint: str, data: dict, **kwargs):
+        self.calls.append(endpoint)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if endpoint == 'getMe':
+            return BOT_USER
+        if endpoint == 'sendMediaGroup':
+            return [self._message(data.get('chat_id', 0)) for _ in data.get('media', [])]
+        if endpoint.startswith('send') or endpoint.startswith('edit'):
+            return self._message(data.get('chat_id', ADMIN_USER['id']))
+        return True
+
+
+class FakeClock:
+    """Подменяет datetime в модуле: now() возвращает заданное время, которое можно сдвигать."""
+
+    def __init__(self, start: datetime):
+        self.current = start
+        clock = self
+
+        class FrozenDatetime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return clock.current.astimezone(tz) if tz else clock.current.replace(tzinfo=None)
+
+        self.datetime = FrozenDatetime
+
+    def advance(self, delta) -> None:
+        self.current += delta
+
+
+_update_ids = itertools.count(1)
+
+
+def make_user(user_id: int) -> dict:
+    return dict(ADMIN_USER, id=user_id, first_name=f"Admin {user_id}")
+
+
+def _user_message(bot, user: dict = ADMIN_USER, **fields) -> dict:
+    message = {
+        'message_id': next(_update_ids),
+        'date': int(time.time()),
+        'chat': {'id': user['id'], 'type': 'private'},
+        'from': user,
+    }
+    message.update(fields)
+    return message
+
+
+def media_update(bot, file_id: str, caption: str | None = None, user: dict = ADMIN_USER) -> Update:
+    """Сообщение администратора с фото, как его получает handle_media."""
+    photo = [{'file_id': file_id, 'file_unique_id': f"u_{file_id}", 'width': 1280, 'height': 720}]
+    data = {'update_id': next(_update_ids), 'message': _user_message(bot, user, photo=photo, caption=caption)}
+    return Update.de_json(data, bot)
+
+
+def callback_update(bot, callback_data: str, user: dict = ADMIN_USER) -> Update:
+    """Нажатие inline-кнопки под сообщением бота с фото."""
+    message = _user_message(bot, user, photo=[{'file_id': 'shown', 'file_unique_id': 'shown', 'width': 1, 'height': 1}])
+    message['from'] = BOT_USER
+    data = {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)),
+            'from': user,
+            'chat_instance': 'bench',
+            'data': callback_data,
+            'message': message,
+        },
+    }
+    return Update.de_json(data, bot)
@@ -0,0 +1,111 @@
+"""Нагрузочный тест обработки обновлений: последовательно, параллельно без блокировок и по очередям пользователей.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.load_test --users 8 --uploads 10 --vk-latency 1.0
+
+Каждый администратор сначала открывает /vk (долгий запрос к VK, имитируется через
+httpx.MockTransport), затем нажимает «Обычный постинг» и присылает uploads мемов.
+В отчете время обработки всех обновлений и сколько мемов дошло до очереди: без
+сериализации по пользователю handle_media может обогнать нажатие кнопки и потерять мем.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import httpx
+
+import main
+from benchmarks.fakes import FakeBot, callback_update, make_user, media_update
+from http_client import start_http_client
+from storage import Storage
+
+BENCH_CHANNEL = main.Channel("-1001000000000", "Нагрузка")
+MODES = {
+    # имя режима -> (UPDATE_CONCURRENCY, функция очереди обновления)
+    'sequential': (1, main.update_lane),
+    'concurrent_unordered': (64, lambda update: None),
+    'per_user': (64, main.update_lane),
+}
+
+
+def vk_transport(latency: float) -> httpx.MockTransport:
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency)
+        return httpx.Response(200, json={'response': {'items': []}})
+    return httpx.MockTransport(handler)
+
+
+async def run_mode(mode: str, users: int, uploads: int, latency: float, vk_latency: float, workdir: str) -> dict:
+    concurrency, lane = MODES[mode]
+    main.UPDATE_CONCURRENCY = concurrency
+    main.update_lane = lane
+    main.db = Storage(os.path.join(workdir, f"{mode}.db"))
+    main.post_schedulers.clear()
+    bot = FakeBot(latency=latency)
+    application = main.build_application(bot=bot)
+    await application.initialize()
+    await main.post_init(application)
+    await start_http_client(transport=vk_transport(vk_latency))
+    await application.start()
+    try:
+        started = time.perf_counter()
+        for user_id in range(1, users + 1):
+            user = make_user(user_id)
+            await application.update_queue.put(callback_update(bot, "vk_post_-1", user))
+            await application.update_queue.put(callback_update(bot, "normal_post", user))
+            for i in range(uploads):
+                await application.update_queue.put(media_update(bot, f"{mode}_{user_id}_{i}", user=user))
+        await application.update_queue.join()
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(main.MEDIA_GROUP_DEBOUNCE * 3)
+        queued = await main.count_posts_in_db(BENCH_CHANNEL.chat_id)
+    finally:
+        await application.stop()
+        await main.post_shutdown(application)
+        await application.shutdown()
+    total = users * (uploads + 2)
+    return {
+        'mode': mode,
+        'updates': total,
+        'elapsed_s': round(elapsed, 3),
+        'updates_per_s': round(total / elapsed, 1),
+        'queued': queued,
+        'expected_queued': users * uploads,
+    }
+
+
+async def run(users: int, uploads: int, latency: float, vk_latency: float) -> dict:
+    main.CHANNELS = [BENCH_CHANNEL]
+    main.CHANNELS_BY_ID = {BENCH_CHANNEL.chat_id: BENCH_CHANNEL}
+    main.MEDIA_GROUP_DEBOUNCE = 0.1
+    main.bot_startup_time = datetime.now(main.MOSCOW_TZ)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in MODES:
+            results.append(await run_mode(mode, users, uploads, latency, vk_latency, workdir))
+    return {'users': users, 'uploads_per_user': uploads, 'results': results}
+
+
+def cli(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест параллельной обработки обновлений.")
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--uploads', type=int, default=10, help="Мемов от каждого администратора")
+    parser.add_argument('--latency', type=float, default=0.05, help="Имитация задержки Bot API, с")
+    parser.add_argument('--vk-latency', type=float, default=1.0, help="Имитация задержки VK API, с")
+    args = parser.parse_args(argv)
+    logging.disable(logging.WARNING)
+    report = asyncio.run(run(args.users, args.uploads, args.latency, args.vk_latency))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    per_user = next(result for result in report['results'] if result['mode'] == 'per_user')
+    return 0 if per_user['queued'] == per_user['expected_queued'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
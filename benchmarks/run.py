@@ -0,0 +1,213 @@
+"""Офлайн-бенчмарки горячих путей бота.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.run --sizes 100 1000 10000 --output bench.json
+    python -m benchmarks.run --baseline bench.json --threshold 1.25
+
+Реальные обработчики из main.py выполняются против FakeBot и временной БД,
+часы заморожены на 10:30 завтрашнего дня, чтобы окно публикаций было открыто.
+Результат - JSON с перцентилями задержки и объемом выделенной памяти на операцию.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+from telegram.ext import Application, CallbackContext
+
+import main
+from benchmarks.fakes import ADMIN_USER, FakeBot, FakeClock, callback_update, media_update
+from storage import Storage
+
+DEFAULT_SIZES = (100, 1000, 10000)
+BENCH_CHANNEL = main.Channel("-1001000000000", "Бенчмарк")
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def measure(name: str, queue_size: int, iterations: int, operation) -> dict:
+    """Запускает operation iterations раз: сначала замер времени, затем отдельно замер выделений памяти."""
+    latencies = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        await operation(i)
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    allocations = []
+    tracemalloc.start()
+    for i in range(max(1, iterations // 5)):
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        await operation(iterations + i)
+        _, peak = tracemalloc.get_traced_memory()
+        allocations.append(peak - baseline)
+    tracemalloc.stop()
+
+    return {
+        'operation': name,
+        'queue_size': queue_size,
+        'iterations': iterations,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p90_ms': round(percentile(latencies, 90), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(max(latencies), 3),
+        'mean_ms': round(statistics.fmean(latencies), 3),
+        'mean_alloc_kb': round(statistics.fmean(allocations) / 1024, 1),
+    }
+
+
+def fake_post(index: int) -> dict:
+    return {'id': str(uuid.uuid4()), 'channel_id': BENCH_CHANNEL.chat_id, 'type': 'photo',
+            'file_id': f"file_{index}", 'caption': None}
+
+
+async def seed_queue(size: int) -> None:
+    batch = 1000
+    for start in range(0, size, batch):
+        await main.add_posts_to_db([fake_post(i) for i in range(start, min(size, start + batch))])
+
+
+async def run_size(application: Application, size: int, iterations: int, workdir: str) -> list[dict]:
+    main.db = Storage(os.path.join(workdir, f"bench_{size}.db"))
+    main.queue_orders.clear()
+    main.post_schedulers.clear()
+    await main.setup_database()
+    await seed_queue(size)
+
+    bot = application.bot
+    job_context = CallbackContext(application)
+    results = []
+
+    async def recalculate(_):
+        await main.recalculate_and_schedule_all_posts(job_context)
+
+    results.append(await measure('recalculate_and_schedule_all_posts', size, iterations, recalculate))
+
+    async def show_item(_):
+        update = callback_update(bot, f"view_queue_{random.randrange(size)}")
+        await main.show_queue_item(update, CallbackContext.from_update(update, application))
+
+    results.append(await measure('show_queue_item', size, iterations, show_item))
+
+    async def ingest(i):
+        update = media_update(bot, f"bench_upload_{i}")
+        context = CallbackContext.from_update(update, application)
+        context.user_data['post_type'] = 'normal_post'
+        await main.handle_media(update, context)
+        context.user_data.pop('flush_task').cancel()
+        await main.flush_pending_posts(context, ADMIN_USER['id'])
+
+    results.append(await measure('handle_media', size, iterations, ingest))
+
+    async def get_post_at(_):
+        await main.get_post_at(BENCH_CHANNEL.chat_id, random.randrange(size))
+
+    async def load_state_cache(_):
+        await main.load_state_cache()
+
+    async def add_and_delete(i):
+        post = fake_post(i)
+        await main.add_post_to_db(post)
+        await main.delete_post_from_db(post['id'])
+
+    results.append(await measure('db.get_post_at', size, iterations, get_post_at))
+    results.append(await measure('db.load_state_cache', size, iterations, load_state_cache))
+    results.append(await measure('db.add_and_delete_post', size, iterations, add_and_delete))
+
+    for job in application.job_queue.jobs():
+        job.schedule_removal()
+    await main.db.close()
+    return results
+
+
+async def run(sizes: list[int], iterations: int) -> dict:
+    tomorrow = datetime.now(main.MOSCOW_TZ) + timedelta(days=1)
+    clock = FakeClock(tomorrow.replace(hour=10, minute=30, second=0, microsecond=0))
+    main.datetime = clock.datetime
+    main.bot_startup_time = clock.current - timedelta(days=1)
+    main.last_post_times.clear()
+    main.CHANNELS = [BENCH_CHANNEL]
+    main.CHANNELS_BY_ID = {BENCH_CHANNEL.chat_id: BENCH_CHANNEL}
+
+    application = Application.builder().bot(FakeBot()).build()
+    await application.initialize()
+    await application.job_queue.start()
+    main.ALLOWED_USER_IDS.append(ADMIN_USER['id'])
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for size in sizes:
+                results.extend(await run_size(application, size, iterations, workdir))
+    finally:
+        await application.job_queue.stop()
+        await application.shutdown()
+    return {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'iterations': iterations,
+        },
+        'results': results,
+    }
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list[str]:
+    """Возвращает операции, у которых p50 вырос больше чем в threshold раз относительно baseline."""
+    previous = {(r['operation'], r['queue_size']): r for r in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        old = previous.get((result['operation'], result['queue_size']))
+        if old and old['p50_ms'] > 0 and result['p50_ms'] > old['p50_ms'] * threshold:
+            regressions.append(
+                f"{result['operation']}[{result['queue_size']}]: p50 {old['p50_ms']} -> {result['p50_ms']} ms"
+            )
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки обработчиков бота.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help="Размеры очереди")
+    parser.add_argument('--iterations', type=int, default=50, help="Повторов каждой операции")
+    parser.add_argument('--output', help="Файл для JSON-отчета (по умолчанию stdout)")
+    parser.add_argument('--baseline', help="Прошлый JSON-отчет для сравнения")
+    parser.add_argument('--threshold', type=float, default=1.25, help="Допустимый рост p50 относительно baseline")
+    return parser.parse_args(argv)
+
+
+def cli(argv=None) -> int:
+    args = parse_args(argv)
+    logging.disable(logging.WARNING)
+    report = asyncio.run(run(args.sizes, args.iterations))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
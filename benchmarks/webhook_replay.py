@@ -0,0 +1,148 @@
+"""Локальная проверка режима webhook: записанные обновления отправляются POST-запросами.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.webhook_replay --updates benchmarks/updates.jsonl --repeat 50
+
+Поднимает настоящее приложение из main.build_application() с FakeBot и временной БД,
+запускает встроенный webhook-сервер PTB на localhost и проверяет, что запросы с верным
+секретом принимаются, с неверным - отклоняются, все обновления обработаны без ошибок в логе,
+а присланные мемы попали в очередь и в план.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import httpx
+
+import main
+from benchmarks.fakes import ADMIN_USER, FakeBot
+from storage import Storage
+
+SECRET = "replay-secret"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def load_updates(path: str) -> list[dict]:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def uploaded_media(updates: list[dict]) -> set[str]:
+    """file_unique_id мемов, которые администратор присылает в записанных обновлениях."""
+    media = set()
+    for update in updates:
+        message = update.get('message', {})
+        if message.get('from', {}).get('id') != ADMIN_USER['id']:
+            continue
+        if message.get('photo'):
+            media.add(message['photo'][-1]['file_unique_id'])
+        for key in ('video', 'animation'):
+            if message.get(key):
+                media.add(message[key]['file_unique_id'])
+    return media
+
+
+class ErrorCollector(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.messages: list[str] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.messages.append(record.getMessage())
+
+
+async def replay(updates: list[dict], repeat: int, concurrency: int, latency: float) -> dict:
+    main.BOT_MODE = 'webhook'
+    main.UPDATE_CONCURRENCY = concurrency
+    main.ALLOWED_USER_IDS.append(ADMIN_USER['id'])
+    channel = main.Channel("-1001000000000", "Replay")
+    main.CHANNELS = [channel]
+    main.CHANNELS_BY_ID = {channel.chat_id: channel}
+    main.MEDIA_GROUP_DEBOUNCE = 0.1
+    main.bot_startup_time = datetime.now(main.MOSCOW_TZ)
+    errors = ErrorCollector()
+    logging.getLogger().addHandler(errors)
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        main.db = Storage(os.path.join(workdir, "replay.db"))
+        bot = FakeBot(latency=latency)
+        application = main.build_application(bot=bot)
+        await application.initialize()
+        await main.post_init(application)
+        await application.updater.start_webhook(
+            listen="127.0.0.1", port=port, url_path=main.WEBHOOK_PATH, secret_token=SECRET
+        )
+        await application.start()
+        url = f"http://127.0.0.1:{port}/{main.WEBHOOK_PATH}"
+        try:
+            async with httpx.AsyncClient() as client:
+                rejected = await client.post(url, json=updates[0], headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+                started = time.perf_counter()
+                statuses = {}
+                for i in range(repeat):
+                    for update in updates:
+                        payload = dict(update, update_id=update['update_id'] + i * len(updates))
+                        response = await client.post(
+                            url, json=payload, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}
+                        )
+                        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                await application.update_queue.join()
+                # Альбом сохраняется после паузы MEDIA_GROUP_DEBOUNCE отдельной задачей.
+                flush_task = application.user_data.get(ADMIN_USER['id'], {}).get('flush_task')
+                if flush_task:
+                    await asyncio.gather(flush_task, return_exceptions=True)
+                elapsed = time.perf_counter() - started
+            queued = len(main.order_for(channel.chat_id))
+            planned = len(main.scheduler_for(channel.chat_id).plan)
+        finally:
+            await application.updater.stop()
+            await application.stop()
+            await main.post_shutdown(application)
+            await application.shutdown()
+            logging.getLogger().removeHandler(errors)
+    total = repeat * len(updates)
+    return {
+        'updates': total,
+        'statuses': statuses,
+        'wrong_secret_status': rejected.status_code,
+        'elapsed_s': round(elapsed, 3),
+        'updates_per_s': round(total / elapsed, 1),
+        'bot_api_calls': len(bot.calls),
+        'expected_queued': len(uploaded_media(updates)),
+        'queued': queued,
+        'planned': planned,
+        'errors': errors.messages,
+    }
+
+
+def cli(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Прогон записанных обновлений через webhook.")
+    parser.add_argument('--updates', default=os.path.join(os.path.dirname(__file__), 'updates.jsonl'))
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05, help="Имитация задержки Bot API, с")
+    args = parser.parse_args(argv)
+    logging.disable(logging.WARNING)
+    report = asyncio.run(replay(load_updates(args.updates), args.repeat, args.concurrency, args.latency))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    ok = (report['statuses'] == {200: report['updates']} and report['wrong_secret_status'] == 403
+          and report['queued'] == report['expected_queued'] > 0
+          and report['planned'] == min(report['queued'], main.PLAN_HORIZON) and not report['errors'])
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
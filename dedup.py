@@ -0,0 +1,108 @@
+import asyncio
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+BANDS = 8
+BAND_BITS = HASH_BITS // BANDS
+_BAND_MASK = (1 << BAND_BITS) - 1
+_HASH_MASK = (1 << HASH_BITS) - 1
+
+_executor: ThreadPoolExecutor | None = None
+
+
+def pillow_available() -> bool:
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def dhash(image_bytes: bytes, size: int = 8) -> int:
+    """Разностный хэш: 64 бита, каждый показывает, светлее ли пиксель соседа справа."""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        pixels = list(image.convert('L').resize((size + 1, size), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            offset = row * (size + 1) + col
+            value = value << 1 | (pixels[offset] > pixels[offset + 1])
+    return value
+
+
+async def compute_dhash(image_bytes: bytes) -> int:
+    """Считает хэш в пуле потоков, чтобы декодирование картинки не блокировало event loop."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="phash")
+    return await asyncio.get_running_loop().run_in_executor(_executor, dhash, image_bytes)
+
+
+def shutdown_hash_pool() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+def to_db(value: int) -> int:
+    """SQLite INTEGER знаковый, поэтому 64-битный хэш хранится в дополнительном коде."""
+    return value - (1 << HASH_BITS) if value >> (HASH_BITS - 1) else value
+
+
+def from_db(value: int) -> int:
+    return value & _HASH_MASK
+
+
+class PerceptualIndex:
+    """LSH-индекс по полосам хэша: хэш делится на BANDS частей, и по принципу Дирихле
+    любой хэш на расстоянии Хэмминга меньше BANDS совпадает с искомым хотя бы в одной полосе."""
+
+    def __init__(self, max_distance: int = 6):
+        if max_distance >= BANDS:
+            raise ValueError(f"max_distance должен быть меньше {BANDS}")
+        self.max_distance = max_distance
+        self.hashes: dict[str, int] = {}
+        self._bands: list[dict[int, set[str]]] = [{} for _ in range(BANDS)]
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    @staticmethod
+    def _band_values(value: int):
+        for band in range(BANDS):
+            yield band, (value >> (band * BAND_BITS)) & _BAND_MASK
+
+    def add(self, key: str, value: int) -> None:
+        self.discard(key)
+        self.hashes[key] = value
+        for band, band_value in self._band_values(value):
+            self._bands[band].setdefault(band_value, set()).add(key)
+
+    def discard(self, key: str) -> None:
+        value = self.hashes.pop(key, None)
+        if value is None:
+            return
+        for band, band_value in self._band_values(value):
+            bucket = self._bands[band][band_value]
+            bucket.discard(key)
+            if not bucket:
+                del self._bands[band][band_value]
+
+    def find(self, value: int) -> list[str]:
+        """Ключи похожих картинок, от самых близких к дальним."""
+        candidates = set()
+        for band, band_value in self._band_values(value):
+            candidates.update(self._bands[band].get(band_value, ()))
+        matches = []
+        for key in candidates:
+            distance = (self.hashes[key] ^ value).bit_count()
+            if distance <= self.max_distance:
+                matches.append((distance, key))
+        return [key for _, key in sorted(matches)]
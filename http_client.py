@@ -0,0 +1,48 @@
+import logging
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+HTTP_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=30.0)
+
+_client: httpx.AsyncClient | None = None
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def create_http_client(http2: bool = False, transport: httpx.AsyncBaseTransport | None = None) -> httpx.AsyncClient:
+    """Создает клиент с пулом соединений, keep-alive и таймаутами."""
+    if http2 and not _http2_available():
+        logger.warning("HTTP/2 запрошен, но пакет h2 не установлен (pip install 'httpx[http2]'). Используется HTTP/1.1.")
+        http2 = False
+    return httpx.AsyncClient(timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS, http2=http2, transport=transport)
+
+
+async def start_http_client(http2: bool = False, transport: httpx.AsyncBaseTransport | None = None) -> None:
+    """Создает общий клиент приложения. transport позволяет подставить httpx.MockTransport в тестах."""
+    global _client
+    await close_http_client()
+    _client = create_http_client(http2=http2, transport=transport)
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Возвращает общий клиент, создавая его при первом обращении."""
+    global _client
+    if _client is None:
+        _client = create_http_client()
+    return _client
+
+
+async def close_http_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
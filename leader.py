@@ -0,0 +1,97 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+LEASE_KEY = 'leader_lease'
+
+
+def _acquire(conn: sqlite3.Connection, replica_id: str, now: float, ttl: float) -> bool:
+    # Один UPSERT атомарен: аренду получает тот, кто ее уже держит, или кто угодно, если она истекла.
+    value = json.dumps({'holder': replica_id, 'expires_at': now + ttl})
+    cursor = conn.execute(
+        "INSERT INTO bot_state (key, value) VALUES (?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value "
+        "WHERE json_extract(bot_state.value, '$.holder') = ? OR json_extract(bot_state.value, '$.expires_at') < ?",
+        (LEASE_KEY, value, replica_id, now)
+    )
+    return cursor.rowcount == 1
+
+
+def _release(conn: sqlite3.Connection, replica_id: str) -> None:
+    conn.execute("DELETE FROM bot_state WHERE key = ? AND json_extract(value, '$.holder') = ?", (LEASE_KEY, replica_id))
+
+
+class LeaderElection:
+    """Аренда лидерства в bot_state: лидер продлевает ее каждые interval секунд, остальные реплики
+    забирают ее, как только она истекла. Время - wall clock, поэтому часы реплик должны быть синхронизированы.
+
+    on_elected/on_demoted вызываются при смене роли, on_follow - на каждом такте, пока реплика ведомая.
+    """
+
+    def __init__(self, storage, replica_id: str, ttl: float = 6.0, interval: float = 2.0,
+                 on_elected=None, on_demoted=None, on_follow=None):
+        if interval >= ttl:
+            raise ValueError("interval должен быть меньше ttl")
+        self.storage = storage
+        self.replica_id = replica_id
+        self.ttl = ttl
+        self.interval = interval
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.on_follow = on_follow
+        self.is_leader = False
+        self._lease_until = 0.0
+        self._task: asyncio.Task | None = None
+
+    def has_lease(self) -> bool:
+        """Лидер и аренда еще не истекла по локальным часам: после долгой паузы процесса это уже не так."""
+        return self.is_leader and time.monotonic() < self._lease_until
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Останавливает продление и отдает аренду, чтобы другая реплика перехватила ее сразу."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.is_leader:
+            self.is_leader = False
+            await self.storage.run(_release, self.replica_id)
+            logger.info("Реплика %s отдала лидерство.", self.replica_id, extra={'replica_id': self.replica_id})
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception("Ошибка такта выбора лидера.")
+            await asyncio.sleep(self.interval)
+
+    async def tick(self) -> None:
+        started = time.monotonic()
+        try:
+            acquired = await self.storage.run(_acquire, self.replica_id, time.time(), self.ttl)
+        except sqlite3.Error as e:
+            # Не удалось продлить аренду - безопаснее считать, что ее уже забрали.
+            logger.warning("Не удалось продлить аренду лидера: %s", e)
+            acquired = False
+        if acquired:
+            self._lease_until = started + self.ttl
+        if acquired and not self.is_leader:
+            self.is_leader = True
+            logger.info("Реплика %s стала лидером.", self.replica_id, extra={'replica_id': self.replica_id})
+            if self.on_elected:
+                await self.on_elected()
+        elif not acquired and self.is_leader:
+            self.is_leader = False
+            logger.warning("Реплика %s потеряла лидерство.", self.replica_id, extra={'replica_id': self.replica_id})
+            if self.on_demoted:
+                await self.on_demoted()
+        elif not acquired and self.on_follow:
+            await self.on_follow()
@@ -0,0 +1,62 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Атрибуты, которые есть у любой записи; все остальное пришло через extra= и попадает в JSON как поле.
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+# Библиотеки, которые пишут строку на каждый запрос к API.
+NOISY_LOGGERS = ('httpx', 'httpcore')
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна JSON-строка: время, уровень, логгер, сообщение и поля из extra."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRS)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _LoopQueueHandler(QueueHandler):
+    """Кладет запись в очередь, не форматируя ее целиком: сообщение собирается один раз, трассировка - строкой."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(level: str = "INFO", log_format: str = "json") -> QueueListener:
+    """Перенаправляет корневой логгер в очередь; запись в поток делает отдельный поток QueueListener."""
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if log_format == "json" else logging.Formatter(TEXT_FORMAT))
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(_LoopQueueHandler(log_queue))
+    root.setLevel(level.upper())
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(max(logging.WARNING, root.level))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -1,23 +1,45 @@
+import argparse
+import asyncio
 import logging
 import uuid
 import os
 import random
+import socket
+import re
 import locale
-import httpx
 import pytz
-import sqlite3
 import json
+import sys
 from collections import deque
+from dataclasses import dataclass
 from datetime import datetime, time, timedelta
+from pathlib import Path
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo, \
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo, \
     InputMediaAnimation
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 from telegram.error import BadRequest
 
+from dedup import PerceptualIndex, compute_dhash, from_db, pillow_available, shutdown_hash_pool, to_db
+from http_client import close_http_client, get_http_client, start_http_client
+from leader import LeaderElection
+from logging_setup import setup_logging
+from metrics import instrumented, metrics, start_metrics_server
+from publisher import ALBUM_MAX_SIZE, ALBUM_MEDIA, SEND_METHODS, Publisher, maybe_delivered, send_media
+from scheduler import DEFAULT_PRIORITY, PRIORITIES, PostScheduler, QueueOrder, plan_slots, slot_interval
+from storage import Storage, apply_migrations, dict_row
+from update_processor import PerUserUpdateProcessor, user_key
+
 # Загружаем переменные окружения из .env файла (для локального запуска)
 load_dotenv()
 
+# Включаем логирование: запись в поток идет из отдельного потока, event loop только кладет записи в очередь.
+# LOG_FORMAT=json - одна JSON-строка на запись с полями post_id, job, duration_ms; text - прежний формат.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+log_listener = setup_logging(LOG_LEVEL, LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
 # Настройка русской локали
 try:
     locale.setlocale(locale.LC_TIME, 'ru_RU.UTF-8')
@@ -25,14 +47,7 @@ except locale.Error:
     try:
         locale.setlocale(locale.LC_TIME, 'ru_RU')
     except locale.Error:
-        logging.warning("Russian locale not found, month/day names might be in English.")
-
-# Включаем логирование
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+        logger.warning("Russian locale not found, month/day names might be in English.")
 
 # --- ВАШИ ДАННЫЕ (из переменных окружения) ---
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -49,6 +64,13 @@ CITY_NAME = os.getenv("CITY_NAME")
 
 VK_SERVICE_TOKEN = os.getenv("VK_SERVICE_TOKEN")
 VK_API_VERSION = "5.131"
+VK_PHOTOS_PER_COMMUNITY = 10
+VK_PAGE_SIZE = 100
+VK_MAX_PAGES = 5
+VK_CONCURRENCY = 3
+# Кэш file_id для фото VK: повторная отправка не заставляет Telegram заново скачивать картинку
+VK_FILE_ID_CACHE_SIZE = 10000
+VK_FILE_ID_TTL_DAYS = 30
 VK_COMMUNITIES_STR = os.getenv("VK_COMMUNITIES", "")
 VK_COMMUNITIES = {}
 if VK_COMMUNITIES_STR:
@@ -57,211 +79,972 @@ if VK_COMMUNITIES_STR:
         if len(parts) == 2:
             VK_COMMUNITIES[parts[0].strip()] = int(parts[1].strip())
 
+
+@dataclass(frozen=True)
+class Channel:
+    chat_id: str
+    name: str
+    start_hour: int = 10
+    end_hour: int = 23
+
+
+# Каналы: "Название:chat_id:10-23" через запятую; окно публикаций в часах по Москве, по умолчанию 10-23.
+# Без CHANNELS бот работает с одним каналом из CHANNEL_ID.
+CHANNELS_STR = os.getenv("CHANNELS", "")
+CHANNELS: list[Channel] = []
+if CHANNELS_STR:
+    for item in CHANNELS_STR.split(','):
+        parts = [part.strip() for part in item.split(':')]
+        if len(parts) >= 2:
+            start_hour, end_hour = (int(hour) for hour in parts[2].split('-')) if len(parts) > 2 else (10, 23)
+            CHANNELS.append(Channel(parts[1], parts[0], start_hour, end_hour))
+elif CHANNEL_ID:
+    CHANNELS.append(Channel(CHANNEL_ID, "Основной канал"))
+CHANNELS_BY_ID = {channel.chat_id: channel for channel in CHANNELS}
+
+CHANNEL_POSTS_PER_MINUTE = float(os.getenv("CHANNEL_POSTS_PER_MINUTE", "20"))
+# Загрузка локальных файлов при импорте идет в личный чат, у которого свой лимит Telegram (около 1 сообщения в секунду)
+UPLOAD_POSTS_PER_MINUTE = float(os.getenv("UPLOAD_POSTS_PER_MINUTE", "60"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 - эндпоинт /metrics выключен
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() == "true"
+# Поиск почти одинаковых фото по перцептивному хэшу; нужен Pillow (pip install Pillow)
+PHASH_ENABLED = os.getenv("PHASH_ENABLED", "false").lower() == "true"
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "6"))
+if PHASH_ENABLED and not pillow_available():
+    logger.warning("PHASH_ENABLED включен, но Pillow не установлен. Проверяются только точные дубликаты.")
+    PHASH_ENABLED = False
+
+# Режим получения обновлений: 'polling' (по умолчанию) или 'webhook'
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip('/')
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # внешний адрес за ingress, без пути
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Сколько обновлений обрабатывается одновременно; обновления одного пользователя все равно идут по очереди
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "8"))
+# Несколько реплик на одной bot_data.db: задачи выполняет только лидер, обработчики работают везде.
+# Реплики должны получать обновления через webhook - getUpdates допускает только одного получателя.
+LEADER_ELECTION_ENABLED = os.getenv("LEADER_ELECTION_ENABLED", "false").lower() == "true"
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}:{os.getpid()}"
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "6"))  # секунды
+LEADER_HEARTBEAT_INTERVAL = float(os.getenv("LEADER_HEARTBEAT_INTERVAL", "2"))  # секунды
+
 DB_NAME = "bot_data.db"
 MOSCOW_TZ = pytz.timezone("Europe/Moscow")
 # --------------------
 
 # --- ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ И КОНСТАНТЫ ---
-last_post_time = None
+last_post_times: dict[str, datetime] = {}
 bot_startup_time = None
+metrics_server = None
 JOB_KWARGS = {'misfire_grace_time': 30}
+RESCHEDULE_TOLERANCE = timedelta(minutes=2)
+# Что делать с постами, слот которых прошел, пока бот был выключен: 'catch_up' или 'reschedule'
+MISSED_POST_POLICY = os.getenv("MISSED_POST_POLICY", "catch_up")
+if MISSED_POST_POLICY not in ('catch_up', 'reschedule'):
+    logger.warning("Неизвестное значение MISSED_POST_POLICY=%r, используется 'reschedule'.", MISSED_POST_POLICY)
+    MISSED_POST_POLICY = 'reschedule'
+# Емкость канала: не больше MAX_POSTS_PER_DAY постов в день и не чаще раза в MIN_POST_SPACING.
+MAX_POSTS_PER_DAY = int(os.getenv("MAX_POSTS_PER_DAY", "20"))
+MIN_POST_SPACING = timedelta(minutes=int(os.getenv("MIN_POST_SPACING_MINUTES", "30")))
+# Сколько ближайших постов канала держать задачами в JobQueue; остальные ждут своей очереди в плане.
+PLAN_HORIZON = int(os.getenv("PLAN_HORIZON", "50"))
+# Режим альбомов: когда в очереди канала больше ALBUM_BACKLOG_THRESHOLD постов, один слот публикует
+# до ALBUM_SIZE идущих подряд фото и видео одним send_media_group. 0 - режим выключен.
+ALBUM_BACKLOG_THRESHOLD = int(os.getenv("ALBUM_BACKLOG_THRESHOLD", "0"))
+ALBUM_SIZE = min(int(os.getenv("ALBUM_SIZE", str(ALBUM_MAX_SIZE))), ALBUM_MAX_SIZE)
+MEDIA_GROUP_DEBOUNCE = 1.5  # секунды ожидания остальных медиа альбома
+# Ключ bot_state, который меняет CLI импорта: бот замечает новое значение и перепланирует очереди один раз.
+QUEUE_REVISION_KEY = 'queue_revision'
+QUEUE_REVISION_CHECK_INTERVAL = 30  # секунды
+RANDOM_MESSAGE_JOB = 'random_message_job'
+IMPORT_BATCH_SIZE = 500
+EXPORT_PAGE_SIZE = 1000
+FIND_PAGE_SIZE = 8
+# Фильтр типа в /find: первое слово запроса -> тип медиа
+FIND_TYPE_ALIASES = {
+    'фото': 'photo', 'photo': 'photo', 'видео': 'video', 'video': 'video',
+    'гиф': 'animation', 'gif': 'animation', 'animation': 'animation',
+}
+MEDIA_LABELS = {'photo': "🖼 Фото", 'video': "🎬 Видео", 'animation': "🎞 GIF"}
+MEDIA_EXTENSIONS = {
+    '.jpg': 'photo', '.jpeg': 'photo', '.png': 'photo', '.webp': 'photo',
+    '.mp4': 'video', '.mov': 'video', '.webm': 'video', '.gif': 'animation',
+}
+WEATHER_CACHE_TTL = timedelta(minutes=30)
+weather_cache: dict[str, tuple[datetime, dict]] = {}
+db = Storage(DB_NAME)
+publisher = Publisher(posts_per_minute=CHANNEL_POSTS_PER_MINUTE)
+# Кэш в памяти процесса: загружается при старте и обновляется при каждой записи (write-through),
+# поэтому меню, ответы о размере очереди и чтение состояния не обращаются к SQLite.
+state_cache: dict[str, str] = {}
+special_posts_cache: dict[tuple[str, str], dict] = {}
+queue_orders: dict[str, QueueOrder] = {}
+phash_indexes: dict[str, PerceptualIndex] = {}
+post_schedulers: dict[str, PostScheduler] = {}
+leader_election: LeaderElection | None = None
 
 
 # --- ФУНКЦИИ ДЛЯ РАБОТЫ С БД ---
 
-def setup_database():
-    """Создает таблицы, если они не существуют."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
+def _create_schema(conn):
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS meme_queue (
             id TEXT PRIMARY KEY,
             post_data TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS special_posts (
             post_type TEXT PRIMARY KEY,
             post_data TEXT NOT NULL
         )
     ''')
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS bot_state (
             key TEXT PRIMARY KEY,
             value TEXT NOT NULL
         )
     ''')
-    conn.commit()
-    conn.close()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS scheduled_posts (
+            post_id TEXT PRIMARY KEY REFERENCES meme_queue (id) ON DELETE CASCADE,
+            run_at TIMESTAMP NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS vk_seen_photos (
+            photo_key TEXT PRIMARY KEY,
+            community_id INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _migrate_to_channels(conn):
+    """Очередь, специальные посты и время последнего поста привязываются к каналу."""
+    default_channel_id = CHANNELS[0].chat_id if CHANNELS else ''
+    conn.execute("ALTER TABLE meme_queue ADD COLUMN channel_id TEXT NOT NULL DEFAULT ''")
+    conn.execute("UPDATE meme_queue SET channel_id = ?", (default_channel_id,))
+    conn.execute("DROP INDEX IF EXISTS idx_meme_queue_created_at")
+    conn.execute("CREATE INDEX idx_meme_queue_channel ON meme_queue (channel_id, created_at)")
+    conn.execute('''
+        CREATE TABLE special_posts_new (
+            channel_id TEXT NOT NULL,
+            post_type TEXT NOT NULL,
+            post_data TEXT NOT NULL,
+            PRIMARY KEY (channel_id, post_type)
+        )
+    ''')
+    conn.execute("INSERT INTO special_posts_new SELECT ?, post_type, post_data FROM special_posts", (default_channel_id,))
+    conn.execute("DROP TABLE special_posts")
+    conn.execute("ALTER TABLE special_posts_new RENAME TO special_posts")
+    conn.execute("UPDATE bot_state SET key = ? WHERE key = 'last_post_time'", (f"last_post_time:{default_channel_id}",))
+
+
+def _migrate_to_typed_columns(conn):
+    """post_data из JSON раскладывается по отдельным колонкам, порядок очереди хранится в position."""
+    conn.execute('''
+        CREATE TABLE meme_queue_new (
+            id TEXT PRIMARY KEY,
+            channel_id TEXT NOT NULL,
+            type TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            file_unique_id TEXT,
+            caption TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            position INTEGER NOT NULL
+        )
+    ''')
+    positions = {}
+
+    def queue_rows():
+        rows = conn.execute(
+            "SELECT id, channel_id, post_data, created_at FROM meme_queue ORDER BY channel_id, created_at, rowid"
+        )
+        for post_id, channel_id, post_data, created_at in rows:
+            post = json.loads(post_data)
+            positions[channel_id] = positions.get(channel_id, 0) + 1
+            yield (post_id, channel_id, post['type'], post['file_id'], post.get('file_unique_id'),
+                   post.get('caption'), created_at, positions[channel_id])
+
+    conn.executemany("INSERT INTO meme_queue_new VALUES (?, ?, ?, ?, ?, ?, ?, ?)", queue_rows())
+    # DROP TABLE каскадно очищает scheduled_posts, поэтому сохраненный план возвращается после переименования.
+    plan = conn.execute("SELECT post_id, run_at FROM scheduled_posts").fetchall()
+    conn.execute("DROP TABLE meme_queue")
+    conn.execute("ALTER TABLE meme_queue_new RENAME TO meme_queue")
+    conn.executemany("INSERT INTO scheduled_posts (post_id, run_at) VALUES (?, ?)", plan)
+    conn.execute("CREATE UNIQUE INDEX idx_meme_queue_position ON meme_queue (channel_id, position)")
+    conn.execute("CREATE INDEX idx_meme_queue_type ON meme_queue (channel_id, type)")
+    conn.execute("CREATE INDEX idx_meme_queue_file_unique_id ON meme_queue (file_unique_id)")
+
+    conn.execute('''
+        CREATE TABLE special_posts_new (
+            channel_id TEXT NOT NULL,
+            post_type TEXT NOT NULL,
+            type TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            file_unique_id TEXT,
+            caption TEXT,
+            PRIMARY KEY (channel_id, post_type)
+        )
+    ''')
+    special_rows = []
+    for channel_id, post_type, post_data in conn.execute("SELECT channel_id, post_type, post_data FROM special_posts"):
+        post = json.loads(post_data)
+        special_rows.append((channel_id, post_type, post['type'], post['file_id'],
+                             post.get('file_unique_id'), post.get('caption')))
+    conn.executemany("INSERT INTO special_posts_new VALUES (?, ?, ?, ?, ?, ?)", special_rows)
+    conn.execute("DROP TABLE special_posts")
+    conn.execute("ALTER TABLE special_posts_new RENAME TO special_posts")
+
+
+def _migrate_add_media_history(conn):
+    """История опубликованных медиа и перцептивный хэш фото для поиска дубликатов."""
+    conn.execute("ALTER TABLE meme_queue ADD COLUMN phash INTEGER")
+    conn.execute('''
+        CREATE TABLE posted_media (
+            channel_id TEXT NOT NULL,
+            file_unique_id TEXT NOT NULL,
+            phash INTEGER,
+            posted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (channel_id, file_unique_id)
+        )
+    ''')
+    conn.execute("DROP INDEX idx_meme_queue_file_unique_id")
+    conn.execute("CREATE INDEX idx_meme_queue_file_unique_id ON meme_queue (channel_id, file_unique_id)")
+
+
+def _migrate_add_vk_file_ids(conn):
+    """Кэш file_id для фото VK, уже загруженных в Telegram."""
+    conn.execute('''
+        CREATE TABLE vk_file_ids (
+            photo_key TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            file_unique_id TEXT NOT NULL,
+            cached_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute("CREATE INDEX idx_vk_file_ids_used_at ON vk_file_ids (used_at)")
+
+
+def _migrate_add_priority(conn):
+    """Приоритет поста: срочные публикуются раньше обычных, филлеры - в последнюю очередь."""
+    conn.execute(f"ALTER TABLE meme_queue ADD COLUMN priority INTEGER NOT NULL DEFAULT {DEFAULT_PRIORITY}")
+    conn.execute("CREATE INDEX idx_meme_queue_priority ON meme_queue (channel_id, priority, position)")
+
+
+def _migrate_add_caption_search(conn):
+    """Полнотекстовый поиск (FTS5) по подписям очереди и истории; история хранит медиа, чтобы его можно было открыть."""
+    # Индекс FTS и кнопки истории ссылаются на строки по номеру. Неявный rowid VACUUM может перенумеровать,
+    # поэтому обе таблицы пересобираются с явным seq INTEGER PRIMARY KEY.
+    conn.execute(f'''
+        CREATE TABLE meme_queue_new (
+            seq INTEGER PRIMARY KEY,
+            id TEXT NOT NULL UNIQUE,
+            channel_id TEXT NOT NULL,
+            type TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            file_unique_id TEXT,
+            caption TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            position INTEGER NOT NULL,
+            phash INTEGER,
+            priority INTEGER NOT NULL DEFAULT {DEFAULT_PRIORITY}
+        )
+    ''')
+    queue_columns = "id, channel_id, type, file_id, file_unique_id, caption, created_at, position, phash, priority"
+    conn.execute(f"INSERT INTO meme_queue_new ({queue_columns}) SELECT {queue_columns} FROM meme_queue "
+                 "ORDER BY channel_id, priority, position")
+    # DROP TABLE каскадно очищает scheduled_posts, поэтому сохраненный план возвращается после переименования.
+    plan = conn.execute("SELECT post_id, run_at FROM scheduled_posts").fetchall()
+    conn.execute("DROP TABLE meme_queue")
+    conn.execute("ALTER TABLE meme_queue_new RENAME TO meme_queue")
+    conn.executemany("INSERT INTO scheduled_posts (post_id, run_at) VALUES (?, ?)", plan)
+    conn.execute("CREATE UNIQUE INDEX idx_meme_queue_position ON meme_queue (channel_id, position)")
+    conn.execute("CREATE INDEX idx_meme_queue_type ON meme_queue (channel_id, type)")
+    conn.execute("CREATE INDEX idx_meme_queue_file_unique_id ON meme_queue (channel_id, file_unique_id)")
+    conn.execute("CREATE INDEX idx_meme_queue_priority ON meme_queue (channel_id, priority, position)")
+
+    conn.execute('''
+        CREATE TABLE posted_media_new (
+            seq INTEGER PRIMARY KEY,
+            channel_id TEXT NOT NULL,
+            file_unique_id TEXT NOT NULL,
+            phash INTEGER,
+            posted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            type TEXT,
+            file_id TEXT,
+            caption TEXT,
+            UNIQUE (channel_id, file_unique_id)
+        )
+    ''')
+    conn.execute("INSERT INTO posted_media_new (channel_id, file_unique_id, phash, posted_at) "
+                 "SELECT channel_id, file_unique_id, phash, posted_at FROM posted_media ORDER BY posted_at")
+    conn.execute("DROP TABLE posted_media")
+    conn.execute("ALTER TABLE posted_media_new RENAME TO posted_media")
+
+    for table in ('meme_queue', 'posted_media'):
+        # External content: индекс хранит только токены, сами подписи остаются в таблице, триггеры держат его в синхроне.
+        conn.execute(f"""
+            CREATE VIRTUAL TABLE {table}_fts USING fts5(
+                caption, content='{table}', content_rowid='seq', tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {table}_fts (rowid, caption) VALUES (new.seq, new.caption);
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, caption) VALUES ('delete', old.seq, old.caption);
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER {table}_fts_update AFTER UPDATE OF caption ON {table} BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, caption) VALUES ('delete', old.seq, old.caption);
+                INSERT INTO {table}_fts (rowid, caption) VALUES (new.seq, new.caption);
+            END
+        """)
+        conn.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+
+
+SCHEMA_MIGRATIONS = [
+    _migrate_to_channels, _migrate_to_typed_columns, _migrate_add_media_history, _migrate_add_vk_file_ids,
+    _migrate_add_priority, _migrate_add_caption_search,
+]
+# Колонки поста в том виде, в котором его ждут publisher и обработчики.
+POST_COLUMNS = "id, channel_id, type, file_id, file_unique_id, caption, priority"
+MEDIA_COLUMNS = "type, file_id, file_unique_id, caption"
+
+
+def _setup_schema(conn):
+    _create_schema(conn)
+    apply_migrations(conn, SCHEMA_MIGRATIONS)
+
+
+@instrumented('db')
+async def setup_database():
+    """Создает таблицы, если они не существуют, и применяет миграции."""
+    await db.run(_setup_schema)
+    await load_state_cache()
     logger.info("База данных успешно настроена.")
 
 
-def save_bot_state(key: str, value: str):
-    """Сохраняет значение состояния бота в БД."""
-    conn = sqlite3.connect(DB_NAME)
+def _read_state(conn):
+    state = dict(conn.execute("SELECT key, value FROM bot_state"))
     cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO bot_state (key, value) VALUES (?, ?)", (key, value))
-    conn.commit()
-    conn.close()
+    cursor.row_factory = dict_row
+    special_posts = cursor.execute(f"SELECT channel_id, post_type, {MEDIA_COLUMNS} FROM special_posts").fetchall()
+    queue = conn.execute("SELECT channel_id, id, priority, position FROM meme_queue").fetchall()
+    return state, special_posts, queue
+
+
+@instrumented('db')
+async def load_state_cache():
+    """Заполняет кэш состояния, специальных постов и порядка очередей одним проходом по БД."""
+    state, special_posts, queue = await db.run(_read_state)
+    state_cache.clear()
+    state_cache.update(state)
+    special_posts_cache.clear()
+    for post_data in special_posts:
+        special_posts_cache[(post_data.pop('channel_id'), post_data.pop('post_type'))] = post_data
+    entries = {}
+    for channel_id, post_id, priority, position in queue:
+        entries.setdefault(channel_id, []).append((post_id, priority, position))
+    queue_orders.clear()
+    queue_orders.update({channel_id: QueueOrder(channel_entries) for channel_id, channel_entries in entries.items()})
+    phash_indexes.clear()
+    if PHASH_ENABLED:
+        rows = await db.fetchall(
+            "SELECT channel_id, file_unique_id, phash FROM meme_queue WHERE phash IS NOT NULL "
+            "UNION ALL SELECT channel_id, file_unique_id, phash FROM posted_media WHERE phash IS NOT NULL"
+        )
+        for channel_id, file_unique_id, phash in rows:
+            phash_index_for(channel_id).add(file_unique_id, from_db(phash))
+
+
+@instrumented('db')
+async def save_bot_state(key: str, value: str):
+    """Сохраняет значение состояния бота в БД и в кэше."""
+    await db.execute("INSERT OR REPLACE INTO bot_state (key, value) VALUES (?, ?)", (key, value))
+    state_cache[key] = value
 
 
 def get_bot_state(key: str) -> str | None:
-    """Получает значение состояния бота из БД."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT value FROM bot_state WHERE key = ?", (key,))
-    row = cursor.fetchone()
-    conn.close()
-    return row[0] if row else None
+    """Получает значение состояния бота из кэша."""
+    return state_cache.get(key)
 
 
-def save_or_update_special_post(post_type: str, post_data: dict):
-    """Сохраняет или обновляет специальный пост (утро/вечер)."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO special_posts (post_type, post_data) VALUES (?, ?)",
-                   (post_type, json.dumps(post_data)))
-    conn.commit()
-    conn.close()
+async def notify_replicas():
+    """Меняет ревизию очереди, чтобы остальные реплики перечитали состояние из БД."""
+    if leader_election is not None:
+        await save_bot_state(QUEUE_REVISION_KEY, str(uuid.uuid4()))
 
 
-def get_special_post(post_type: str) -> dict | None:
-    """Получает специальный пост из БД."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT post_data FROM special_posts WHERE post_type = ?", (post_type,))
-    row = cursor.fetchone()
-    conn.close()
-    return json.loads(row[0]) if row else None
+async def queue_revision_changed() -> bool:
+    row = await db.fetchone("SELECT value FROM bot_state WHERE key = ?", (QUEUE_REVISION_KEY,))
+    return bool(row) and row[0] != get_bot_state(QUEUE_REVISION_KEY)
 
 
-def delete_special_post(post_type: str):
-    """Удаляет специальный пост из БД."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM special_posts WHERE post_type = ?", (post_type,))
-    conn.commit()
-    conn.close()
+def restore_last_post_times():
+    for channel in CHANNELS:
+        last_post_time_str = get_bot_state(f'last_post_time:{channel.chat_id}')
+        if last_post_time_str:
+            last_post_times[channel.chat_id] = datetime.fromisoformat(last_post_time_str)
+            logger.info("Восстановлено время последнего поста канала %s: %s",
+                        channel.name, last_post_times[channel.chat_id].strftime('%Y-%m-%d %H:%M:%S %Z'))
 
 
-def add_post_to_db(post_data: dict):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO meme_queue (id, post_data) VALUES (?, ?)",
-                   (post_data['id'], json.dumps(post_data)))
-    conn.commit()
-    conn.close()
+@instrumented('db')
+async def save_or_update_special_post(channel_id: str, post_type: str, post_data: dict):
+    """Сохраняет или обновляет специальный пост (утро/вечер) канала."""
+    await db.execute(
+        "INSERT OR REPLACE INTO special_posts (channel_id, post_type, type, file_id, file_unique_id, caption) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (channel_id, post_type, post_data['type'], post_data['file_id'],
+         post_data.get('file_unique_id'), post_data.get('caption'))
+    )
+    special_posts_cache[(channel_id, post_type)] = {
+        'type': post_data['type'], 'file_id': post_data['file_id'],
+        'file_unique_id': post_data.get('file_unique_id'), 'caption': post_data.get('caption'),
+    }
+    await notify_replicas()
 
 
-def get_all_posts_from_db() -> list:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT post_data FROM meme_queue ORDER BY created_at ASC")
-    rows = cursor.fetchall()
-    conn.close()
-    return [json.loads(row[0]) for row in rows]
+def get_special_post(channel_id: str, post_type: str) -> dict | None:
+    """Получает специальный пост канала из кэша."""
+    post_data = special_posts_cache.get((channel_id, post_type))
+    return dict(post_data) if post_data else None
 
 
-def delete_post_from_db(post_id: str):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM meme_queue WHERE id = ?", (post_id,))
-    conn.commit()
-    conn.close()
+@instrumented('db')
+async def delete_special_post(channel_id: str, post_type: str):
+    """Удаляет специальный пост канала из БД и из кэша."""
+    await db.execute("DELETE FROM special_posts WHERE channel_id = ? AND post_type = ?", (channel_id, post_type))
+    special_posts_cache.pop((channel_id, post_type), None)
+    await notify_replicas()
 
 
-def count_posts_in_db() -> int:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM meme_queue")
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+@instrumented('db')
+async def add_post_to_db(post_data: dict):
+    await add_posts_to_db([post_data])
+
+
+@instrumented('db')
+async def add_posts_to_db(posts: list[dict]):
+    """Добавляет несколько постов в очереди их каналов одной транзакцией."""
+    await insert_posts(posts)
+    for post_data in posts:
+        order_for(post_data['channel_id']).add(
+            post_data['id'], post_data.get('priority', DEFAULT_PRIORITY), post_data['position']
+        )
+        if post_data.get('phash') is not None and post_data.get('file_unique_id'):
+            phash_index_for(post_data['channel_id']).add(post_data['file_unique_id'], post_data['phash'])
+    await notify_replicas()
+
+
+async def insert_posts(posts: list[dict]):
+    """Только запись в БД, без кэша в памяти: позиции проставляются в post_data['position']."""
+    def write(conn):
+        # Новый пост встает в конец своего приоритета; MAX(position) берется из индекса.
+        next_positions, rows = {}, []
+        for post_data in posts:
+            channel_id = post_data['channel_id']
+            if channel_id not in next_positions:
+                next_positions[channel_id] = conn.execute(
+                    "SELECT COALESCE(MAX(position), 0) + 1 FROM meme_queue WHERE channel_id = ?", (channel_id,)
+                ).fetchone()[0]
+            post_data['position'] = next_positions[channel_id]
+            next_positions[channel_id] += 1
+            rows.append((post_data['id'], channel_id, post_data['type'], post_data['file_id'],
+                         post_data.get('file_unique_id'), post_data.get('caption'),
+                         to_db(post_data['phash']) if post_data.get('phash') is not None else None,
+                         post_data.get('priority', DEFAULT_PRIORITY), post_data['position']))
+        conn.executemany(
+            "INSERT INTO meme_queue (id, channel_id, type, file_id, file_unique_id, caption, phash, priority, position) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+    # MAX(position) и INSERT в одной пишущей транзакции: иначе параллельный писатель (CLI импорта,
+    # другая реплика) получит ту же позицию и упадет на idx_meme_queue_position.
+    await db.run_immediate(write)
+
+
+@instrumented('db')
+async def get_post(post_id: str) -> dict | None:
+    return await db.fetchone(f"SELECT {POST_COLUMNS} FROM meme_queue WHERE id = ?", (post_id,), row_factory=dict_row)
+
+
+@instrumented('db')
+async def load_plan() -> dict[str, dict[str, datetime]]:
+    """Возвращает сохраненный план, сгруппированный по каналам."""
+    rows = await db.fetchall(
+        "SELECT q.channel_id, s.post_id, s.run_at FROM scheduled_posts s JOIN meme_queue q ON q.id = s.post_id"
+    )
+    plans = {}
+    for channel_id, post_id, run_at in rows:
+        plans.setdefault(channel_id, {})[post_id] = datetime.fromisoformat(run_at)
+    return plans
+
+
+@instrumented('db')
+async def save_plan_changes(upserted: dict[str, datetime], removed: list[str]):
+    """Сохраняет изменившиеся слоты одной транзакцией."""
+    def write(conn):
+        conn.executemany("DELETE FROM scheduled_posts WHERE post_id = ?", [(post_id,) for post_id in removed])
+        # Пост мог быть удален из очереди, пока считался план, поэтому вставляем только существующие.
+        conn.executemany(
+            "INSERT INTO scheduled_posts (post_id, run_at) SELECT id, ? FROM meme_queue WHERE id = ? "
+            "ON CONFLICT(post_id) DO UPDATE SET run_at = excluded.run_at",
+            [(run_at.isoformat(), post_id) for post_id, run_at in upserted.items()]
+        )
+    if upserted or removed:
+        await db.run(write)
+
+
+@instrumented('db')
+async def get_post_at(channel_id: str, index: int) -> dict | None:
+    """Получает один пост очереди канала по его месту в порядке публикации, не загружая остальные."""
+    post_ids = order_for(channel_id).ids(index, index + 1)
+    return await get_post(post_ids[0]) if post_ids else None
+
+
+@instrumented('db')
+async def delete_post_from_db(post_id: str) -> str | None:
+    """Удаляет пост из очереди его канала и возвращает channel_id; None - поста уже нет."""
+    row = await db.run(
+        lambda conn: conn.execute("DELETE FROM meme_queue WHERE id = ? RETURNING channel_id", (post_id,)).fetchone()
+    )
+    if not row:
+        return None
+    order_for(row[0]).remove(post_id)
+    await notify_replicas()
+    return row[0]
+
+
+@instrumented('db')
+async def set_post_priority(channel_id: str, post_id: str, priority: int) -> int | None:
+    """Меняет приоритет поста канала и возвращает его новое место в очереди; None - в очереди канала его нет."""
+    def update(conn):
+        return conn.execute(
+            "UPDATE meme_queue SET priority = ? WHERE id = ? AND channel_id = ? RETURNING position",
+            (priority, post_id, channel_id)
+        ).fetchone()
+    row = await db.run(update)
+    if not row:
+        return None
+    await notify_replicas()
+    return order_for(channel_id).add(post_id, priority, row[0])
+
+
+def order_for(channel_id: str) -> QueueOrder:
+    order = queue_orders.get(channel_id)
+    if order is None:
+        order = queue_orders[channel_id] = QueueOrder()
+    return order
+
+
+async def count_posts_in_db(channel_id: str) -> int:
+    """Возвращает размер очереди канала из порядка в памяти, без COUNT(*)."""
+    return len(order_for(channel_id))
+
+
+def phash_index_for(channel_id: str) -> PerceptualIndex:
+    index = phash_indexes.get(channel_id)
+    if index is None:
+        index = phash_indexes[channel_id] = PerceptualIndex(PHASH_MAX_DISTANCE)
+    return index
+
+
+def _media_status(conn, channel_id: str, file_unique_id: str) -> str | None:
+    if conn.execute("SELECT 1 FROM meme_queue WHERE channel_id = ? AND file_unique_id = ?",
+                    (channel_id, file_unique_id)).fetchone():
+        return 'queued'
+    if conn.execute("SELECT 1 FROM posted_media WHERE channel_id = ? AND file_unique_id = ?",
+                    (channel_id, file_unique_id)).fetchone():
+        return 'posted'
+    return None
+
+
+@instrumented('db')
+async def find_duplicate(channel_id: str, file_unique_id: str, phash: int | None = None) -> str | None:
+    """Возвращает 'queued' или 'posted', если этот мем (или очень похожее фото) уже был в канале."""
+    status = await db.run(_media_status, channel_id, file_unique_id)
+    if status or phash is None or channel_id not in phash_indexes:
+        return status
+    index = phash_indexes[channel_id]
+    for candidate in index.find(phash):
+        status = await db.run(_media_status, channel_id, candidate)
+        if status:
+            return status
+        # Пост удалили из очереди, не опубликовав: хэш больше не нужен.
+        index.discard(candidate)
+    return None
+
+
+@instrumented('db')
+async def archive_posts(channel_id: str, post_ids: list[str]):
+    """Переносит медиа опубликованных постов в историю и удаляет посты из очереди одной транзакцией."""
+    placeholders = ", ".join("?" * len(post_ids))
+
+    def archive(conn):
+        conn.execute(
+            "INSERT OR IGNORE INTO posted_media (channel_id, file_unique_id, phash, type, file_id, caption) "
+            f"SELECT channel_id, file_unique_id, phash, type, file_id, caption FROM meme_queue "
+            f"WHERE id IN ({placeholders}) AND file_unique_id IS NOT NULL",
+            post_ids
+        )
+        conn.execute(f"DELETE FROM meme_queue WHERE id IN ({placeholders})", post_ids)
+
+    await db.run(archive)
+    order = order_for(channel_id)
+    for post_id in post_ids:
+        order.remove(post_id)
+    await notify_replicas()
+
+
+def fts_query(text: str) -> str | None:
+    """Каждое слово ищется как префикс: «кот» найдет и «коты», и «котик»."""
+    words = re.findall(r'\w+', text)
+    return " ".join(f'"{word}"*' for word in words) or None
+
+
+@instrumented('db')
+async def search_captions(channel_id: str, query: str, media_type: str | None = None,
+                          offset: int = 0, limit: int = FIND_PAGE_SIZE) -> list[dict]:
+    """Посты очереди и истории канала, подпись которых подходит под FTS-запрос: сначала очередь, внутри - по релевантности."""
+    type_filter = "AND {table}.type = :type" if media_type else ""
+    return await db.fetchall(f"""
+        SELECT 'queue' AS source, q.id AS item_id, q.type, q.caption, bm25(meme_queue_fts) AS rank
+        FROM meme_queue_fts JOIN meme_queue q ON q.seq = meme_queue_fts.rowid
+        WHERE meme_queue_fts MATCH :query AND q.channel_id = :channel_id {type_filter.format(table='q')}
+        UNION ALL
+        SELECT 'history', h.seq, h.type, h.caption, bm25(posted_media_fts)
+        FROM posted_media_fts JOIN posted_media h ON h.seq = posted_media_fts.rowid
+        WHERE posted_media_fts MATCH :query AND h.channel_id = :channel_id {type_filter.format(table='h')}
+        ORDER BY source DESC, rank
+        LIMIT :limit OFFSET :offset
+    """, {'query': query, 'channel_id': channel_id, 'type': media_type, 'limit': limit, 'offset': offset},
+        row_factory=dict_row)
+
+
+@instrumented('db')
+async def get_posted_media(seq: int) -> dict | None:
+    return await db.fetchone(
+        "SELECT type, file_id, caption, posted_at FROM posted_media WHERE seq = ?", (seq,), row_factory=dict_row
+    )
+
+
+@instrumented('db')
+async def get_album_posts(channel_id: str, post_data: dict) -> list[dict]:
+    """Пост и идущие за ним в очереди фото и видео, которые можно отправить с ним одним альбомом."""
+    order = order_for(channel_id)
+    index = order.index(post_data['id'])
+    if index is None or post_data['type'] not in ALBUM_MEDIA:
+        return [post_data]
+    next_ids = order.ids(index + 1, index + ALBUM_SIZE)
+    if not next_ids:
+        return [post_data]
+    rows = await db.fetchall(
+        f"SELECT {POST_COLUMNS} FROM meme_queue WHERE id IN ({', '.join('?' * len(next_ids))})",
+        next_ids, row_factory=dict_row
+    )
+    by_id = {row['id']: row for row in rows}
+    album = [post_data]
+    for post_id in next_ids:
+        post = by_id.get(post_id)
+        if post is None or post['type'] not in ALBUM_MEDIA:
+            break
+        album.append(post)
+    return album
+
+
+async def photo_hash(bot, photo_sizes) -> int | None:
+    """Перцептивный хэш по самой маленькой копии фото: для сетки 9x8 большего не нужно."""
+    try:
+        telegram_file = await bot.get_file(photo_sizes[0].file_id)
+        return await compute_dhash(bytes(await telegram_file.download_as_bytearray()))
+    except Exception as e:
+        logger.warning("Не удалось посчитать перцептивный хэш фото: %s", e)
+        return None
 
 
 # --- ФУНКЦИИ ДЛЯ ИНТЕГРАЦИИ С VK ---
-async def fetch_vk_photos(community_id: int, count: int = 10) -> list[str]:
-    """Делает запрос к VK API и возвращает список URL последних фотографий."""
-    photo_urls = []
+@instrumented('db')
+async def get_seen_vk_photos(photo_keys: list[str]) -> set[str]:
+    """Возвращает ключи фото, которые уже были отправлены раньше."""
+    if not photo_keys:
+        return set()
+    placeholders = ','.join('?' * len(photo_keys))
+    rows = await db.fetchall(f"SELECT photo_key FROM vk_seen_photos WHERE photo_key IN ({placeholders})", photo_keys)
+    return {row[0] for row in rows}
+
+
+@instrumented('db')
+async def mark_vk_photos_seen(community_id: int, photos: list[tuple[str, str]]):
+    await db.executemany("INSERT OR IGNORE INTO vk_seen_photos (photo_key, community_id, url) VALUES (?, ?, ?)",
+                         [(photo_key, community_id, url) for photo_key, url in photos])
+
+
+@instrumented('db')
+async def get_vk_file_ids(photo_keys: list[str]) -> dict[str, tuple[str, str]]:
+    """Возвращает (file_id, file_unique_id) уже загруженных фото не старше TTL и отмечает их использование."""
+    if not photo_keys:
+        return {}
+
+    def lookup(conn):
+        placeholders = ','.join('?' * len(photo_keys))
+        rows = conn.execute(
+            f"SELECT photo_key, file_id, file_unique_id FROM vk_file_ids WHERE photo_key IN ({placeholders}) "
+            "AND cached_at > datetime('now', ?)", (*photo_keys, f"-{VK_FILE_ID_TTL_DAYS} days")
+        ).fetchall()
+        conn.executemany("UPDATE vk_file_ids SET used_at = CURRENT_TIMESTAMP WHERE photo_key = ?",
+                         [(row[0],) for row in rows])
+        return {photo_key: (file_id, file_unique_id) for photo_key, file_id, file_unique_id in rows}
+
+    return await db.run(lookup)
+
+
+@instrumented('db')
+async def cache_vk_file_ids(entries: list[tuple[str, str, str]]):
+    """Сохраняет file_id и вытесняет записи старше TTL и давно не использованные сверх VK_FILE_ID_CACHE_SIZE."""
+    def write(conn):
+        conn.executemany("INSERT OR REPLACE INTO vk_file_ids (photo_key, file_id, file_unique_id) VALUES (?, ?, ?)",
+                         entries)
+        conn.execute("DELETE FROM vk_file_ids WHERE cached_at <= datetime('now', ?)", (f"-{VK_FILE_ID_TTL_DAYS} days",))
+        conn.execute(
+            "DELETE FROM vk_file_ids WHERE photo_key IN "
+            "(SELECT photo_key FROM vk_file_ids ORDER BY used_at DESC LIMIT -1 OFFSET ?)", (VK_FILE_ID_CACHE_SIZE,)
+        )
+    if entries:
+        await db.run(write)
+
+
+async def fetch_vk_photos(community_id: int, count: int = VK_PHOTOS_PER_COMMUNITY) -> list[tuple[str, str]]:
+    """Листает стену сообщества и возвращает до count еще не отправленных фото в виде (ключ, URL)."""
+    photos = []
+    found_keys = set()
     api_url = "https://api.vk.com/method/wall.get"
-    params = {
-        "owner_id": community_id,
-        "count": 40,
-        "access_token": VK_SERVICE_TOKEN,
-        "v": VK_API_VERSION
-    }
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(api_url, params=params)
+        for page in range(VK_MAX_PAGES):
+            params = {
+                "owner_id": community_id,
+                "count": VK_PAGE_SIZE,
+                "offset": page * VK_PAGE_SIZE,
+                "access_token": VK_SERVICE_TOKEN,
+                "v": VK_API_VERSION
+            }
+            response = await get_http_client().get(api_url, params=params)
             response.raise_for_status()
             data = response.json()
-        if 'error' in data:
-            logger.error(f"VK API Error: {data['error']['error_msg']}")
-            return []
-        for post in data['response']['items']:
-            if 'attachments' not in post:
-                continue
-            for attachment in post['attachments']:
-                if attachment['type'] == 'photo':
-                    max_size_photo = max(attachment['photo']['sizes'], key=lambda size: size['width'])
-                    photo_urls.append(max_size_photo['url'])
-                    if len(photo_urls) >= count:
-                        return photo_urls
-        return photo_urls
+            if 'error' in data:
+                logger.error("VK API Error: %s", data['error']['error_msg'])
+                return photos
+            items = data['response']['items']
+            page_photos = []
+            for post in items:
+                for attachment in post.get('attachments', []):
+                    if attachment['type'] == 'photo':
+                        photo = attachment['photo']
+                        max_size_photo = max(photo['sizes'], key=lambda size: size['width'])
+                        page_photos.append((f"{photo['owner_id']}_{photo['id']}", max_size_photo['url']))
+            seen_keys = await get_seen_vk_photos([photo_key for photo_key, _ in page_photos])
+            for photo_key, url in page_photos:
+                if photo_key in seen_keys or photo_key in found_keys:
+                    continue
+                found_keys.add(photo_key)
+                photos.append((photo_key, url))
+                if len(photos) >= count:
+                    return photos
+            if len(items) < VK_PAGE_SIZE:
+                break
+        return photos
     except Exception as e:
-        logger.error(f"Ошибка при запросе к VK API: {e}")
-        return []
+        logger.error("Ошибка при запросе к VK API: %s", e)
+        return photos
+
+
+async def fetch_vk_photos_from_all(community_ids: list[int]) -> list[list[tuple[str, str]]]:
+    """Загружает новые фото из нескольких сообществ параллельно, не больше VK_CONCURRENCY запросов одновременно."""
+    semaphore = asyncio.Semaphore(VK_CONCURRENCY)
+
+    async def fetch_limited(community_id: int) -> list[tuple[str, str]]:
+        async with semaphore:
+            return await fetch_vk_photos(community_id)
+
+    return await asyncio.gather(*(fetch_limited(community_id) for community_id in community_ids))
 
 
 # --- "УМНЫЙ" ПЛАНИРОВЩИК ---
 
-async def recalculate_and_schedule_all_posts(context: ContextTypes.DEFAULT_TYPE) -> None:
-    for job in context.job_queue.jobs():
-        if job.name and job.name.startswith("normal_post_job_"):
-            job.schedule_removal()
-    logger.info("Все старые задачи для обычных постов удалены. Начинается перепланирование.")
+def scheduler_for(channel_id: str) -> PostScheduler:
+    scheduler = post_schedulers.get(channel_id)
+    if scheduler is None:
+        scheduler = post_schedulers[channel_id] = PostScheduler(
+            post_normal_meme, channel_id, JOB_KWARGS, RESCHEDULE_TOLERANCE
+        )
+    return scheduler
+
+
+async def apply_plan(context: ContextTypes.DEFAULT_TYPE, channel: Channel, new_plan: dict[str, datetime],
+                     tolerance: timedelta | None = None) -> None:
+    """Применяет план канала к JobQueue и сохраняет в БД только изменившиеся слоты."""
+    diff = scheduler_for(channel.chat_id).apply(context.job_queue, new_plan, tolerance)
+    await save_plan_changes({**diff.added, **diff.moved}, diff.removed)
+    if diff.added or diff.moved or diff.removed:
+        # Одна строка на перепланирование; слоты отдельных постов пишет PostScheduler на уровне DEBUG.
+        logger.info(
+            "План обычных постов канала %s обновлен: добавлено %d, перенесено %d, удалено %d, в плане %d до %s.",
+            channel.name, len(diff.added), len(diff.moved), len(diff.removed), len(new_plan),
+            max(new_plan.values()).strftime('%Y-%m-%d %H:%M') if new_plan else "-",
+            extra={'channel_id': channel.chat_id},
+        )
 
-    posts_to_schedule = get_all_posts_from_db()
-    if not posts_to_schedule:
-        logger.info("Очередь пуста, планировать нечего.")
+
+def channel_windows(channel: Channel, now: datetime, days: int):
+    """Окна публикаций канала начиная с сегодняшнего дня."""
+    for day in range(days):
+        date = now + timedelta(days=day)
+        yield (date.replace(hour=channel.start_hour, minute=0, second=0, microsecond=0),
+               date.replace(hour=channel.end_hour, minute=0, second=0, microsecond=0))
+
+
+async def recalculate_channel(context: ContextTypes.DEFAULT_TYPE, channel: Channel) -> None:
+    """Раскладывает очередь канала по сетке слотов на ближайшие дни; задачи ставятся только для PLAN_HORIZON постов."""
+    if not is_leader():
+        # План строит лидер: он увидит новую ревизию очереди и перепланирует сам.
+        return
+    order = order_for(channel.chat_id)
+    post_ids = order.ids(0, PLAN_HORIZON)
+    if not post_ids:
+        await apply_plan(context, channel, {})
+        logger.info("Очередь канала %s пуста, планировать нечего.", channel.name)
         return
 
     now = datetime.now(MOSCOW_TZ)
-    start_of_day = now.replace(hour=10, minute=0, second=0, microsecond=0)
-    one_hour_from_startup = bot_startup_time + timedelta(hours=1)
-    one_hour_from_last_post = last_post_time + timedelta(hours=1) if last_post_time else now
+    earliest = max(now, bot_startup_time + timedelta(hours=1))
+    last_post_time = last_post_times.get(channel.chat_id)
+    if last_post_time:
+        earliest = max(earliest, last_post_time + MIN_POST_SPACING)
+
+    # Сетка слотов не зависит от длины очереди: добавление поста не сдвигает уже назначенные слоты.
+    # Каждый день дает хотя бы один слот, поэтому len(post_ids) + 1 дней всегда достаточно.
+    windows = channel_windows(channel, now, len(post_ids) + 1)
+    slots = plan_slots(len(post_ids), windows, earliest, MAX_POSTS_PER_DAY, MIN_POST_SPACING)
+    # Допуск не больше половины шага сетки, иначе сдвиг на соседний слот не считался бы переносом.
+    tolerance = RESCHEDULE_TOLERANCE
+    if MAX_POSTS_PER_DAY > 0 and channel.end_hour > channel.start_hour:
+        interval = slot_interval(timedelta(hours=channel.end_hour - channel.start_hour), MAX_POSTS_PER_DAY,
+                                 MIN_POST_SPACING)
+        tolerance = min(tolerance, interval / 2)
+    await apply_plan(context, channel, dict(zip(post_ids, slots)), tolerance)
+    if not slots:
+        logger.warning("Окно публикаций канала %s пустое, посты не запланированы.", channel.name)
+
+
+@instrumented('job')
+async def recalculate_and_schedule_all_posts(context: ContextTypes.DEFAULT_TYPE) -> None:
+    for channel in CHANNELS:
+        await recalculate_channel(context, channel)
+
+
+def catch_up_slots(channel: Channel, now: datetime, count: int, taken) -> list[datetime]:
+    """Первые count слотов сетки начиная с now, не ближе MIN_POST_SPACING к последнему посту и к слотам taken."""
+    taken = list(taken)
+    earliest = now
+    last_post_time = last_post_times.get(channel.chat_id)
+    if last_post_time:
+        earliest = max(earliest, last_post_time + MIN_POST_SPACING)
+    # Слоты сетки отстоят друг от друга не меньше чем на MIN_POST_SPACING, поэтому каждое занятое
+    # время исключает не больше двух слотов.
+    candidates = count + 2 * len(taken)
+    slots = plan_slots(candidates, channel_windows(channel, now, candidates + 1), earliest,
+                       MAX_POSTS_PER_DAY, MIN_POST_SPACING)
+    free = [slot for slot in slots if all(abs(slot - run_at) >= MIN_POST_SPACING for run_at in taken)]
+    return free[:count]
+
+
+@instrumented('job')
+async def restore_schedule(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Восстанавливает сохраненный план после перезапуска вместо полного перепланирования."""
+    saved_plans = await load_plan()
+    now = datetime.now(MOSCOW_TZ)
+    for channel in CHANNELS:
+        saved_plan = saved_plans.get(channel.chat_id, {})
+        plan = {post_id: run_at for post_id, run_at in saved_plan.items() if run_at > now}
+        missed = sorted((post_id for post_id in saved_plan if post_id not in plan), key=saved_plan.get)
+        caught_up = {}
+        if missed and MISSED_POST_POLICY == 'catch_up':
+            # Пропущенные за время простоя посты занимают ближайшие свободные слоты сетки: окно канала,
+            # MAX_POSTS_PER_DAY и MIN_POST_SPACING соблюдаются так же, как при обычном планировании.
+            caught_up = dict(zip(missed, catch_up_slots(channel, now, len(missed), plan.values())))
+            plan.update(caught_up)
+            logger.info("Пропущенных постов канала %s: %d, они займут ближайшие свободные слоты.",
+                        channel.name, len(missed))
+        elif missed:
+            # Политика 'reschedule': пропущенные посты получат новые слоты при перепланировании.
+            logger.info("Пропущенных постов канала %s: %d, они будут перепланированы.", channel.name, len(missed))
+        diff = scheduler_for(channel.chat_id).apply(context.job_queue, plan)
+        if missed:
+            await save_plan_changes(caught_up, [post_id for post_id in missed if post_id not in caught_up])
+        logger.info("Восстановлено задач обычных постов канала %s: %d.", channel.name, len(diff.added))
+    for channel in CHANNELS:
+        # Досчитываем план, только если в горизонте остались свободные места.
+        if len(scheduler_for(channel.chat_id).plan) < min(PLAN_HORIZON, len(order_for(channel.chat_id))):
+            await recalculate_channel(context, channel)
+
+
+@instrumented('job')
+async def check_queue_revision(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Подхватывает изменения очереди, сделанные другим процессом (CLI импорта, ведомая реплика), и перепланирует один раз."""
+    if not await queue_revision_changed():
+        return
+    logger.info("Очередь изменена извне, перечитываю состояние и перепланирую посты.")
+    await load_state_cache()
+    await recalculate_and_schedule_all_posts(context)
 
-    scheduling_start_time = max(now, start_of_day, one_hour_from_startup, one_hour_from_last_post)
-    scheduling_end_time = now.replace(hour=23, minute=0, second=0, microsecond=0)
 
-    if scheduling_start_time >= scheduling_end_time:
-        logger.info("Временное окно на сегодня закрыто. Посты будут запланированы завтра.")
-        return
+# --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ И КОМАНДЫ ---
 
-    num_posts = len(posts_to_schedule)
-    available_duration = scheduling_end_time - scheduling_start_time
-    interval = available_duration / (num_posts + 1)
+async def fetch_forecast(force: bool = False) -> dict | None:
+    """Возвращает прогноз из кэша, обновляя его после WEATHER_CACHE_TTL. При ошибке API отдает последний удачный."""
+    now = datetime.now(MOSCOW_TZ)
+    cached = weather_cache.get(CITY_NAME)
+    if cached and not force and now - cached[0] < WEATHER_CACHE_TTL:
+        return cached[1]
+    url = f"https://api.openweathermap.org/data/2.5/forecast?q={CITY_NAME}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
+    try:
+        response = await get_http_client().get(url)
+        response.raise_for_status()
+        data = response.json()
+    except Exception as e:
+        logger.error("Ошибка при получении данных о погоде: %s", e)
+        return cached[1] if cached else None
+    weather_cache[CITY_NAME] = (now, data)
+    return data
 
-    for i, post_data in enumerate(posts_to_schedule):
-        post_time = scheduling_start_time + (interval * (i + 1))
-        job_name = f"normal_post_job_{post_data['id']}"
-        context.job_queue.run_once(
-            post_normal_meme, when=post_time, data=post_data, name=job_name,
-            job_kwargs=JOB_KWARGS
-        )
-        logger.info(f"Пост {post_data['id']} запланирован на {post_time.strftime('%Y-%m-%d %H:%M:%S %Z')}")
 
+@instrumented('job')
+async def prefetch_weather(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Заранее обновляет кэш прогноза, чтобы приветствие не ждало OpenWeather."""
+    if not is_leader():
+        return
+    await fetch_forecast(force=True)
+    logger.info("Прогноз погоды для г. %s обновлен заранее.", CITY_NAME)
 
-# --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ И КОМАНДЫ ---
 
 async def get_weather_text() -> str:
-    url = f"https://api.openweathermap.org/data/2.5/forecast?q={CITY_NAME}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
+    data = await fetch_forecast()
+    if data is None:
+        return "Не удалось загрузить данные о погоде."
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            data = response.json()
         now = datetime.now(MOSCOW_TZ)
         today_date_str = now.strftime("%Y-%m-%d")
         daily_forecasts = [f for f in data['list'] if f['dt_txt'].startswith(today_date_str)]
@@ -281,10 +1064,11 @@ async def get_weather_text() -> str:
             f"  • Макс: {temp_max}°C\n  • Мин: {temp_min}°C\n  • Ветер: {wind_speed:.1f} м/с."
         )
     except Exception as e:
-        logger.error(f"Ошибка при получении или обработке данных о погоде: {e}")
+        logger.error("Ошибка при обработке данных о погоде: %s", e)
         return "Не удалось загрузить данные о погоде."
 
 
+@instrumented('handler')
 async def show_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     if user_id not in ALLOWED_USER_IDS: return
@@ -304,6 +1088,34 @@ async def show_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(response, parse_mode='Markdown')
 
 
+@instrumented('handler')
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    if user_id not in ALLOWED_USER_IDS: return
+    sections = {'handler': "⚙️ Обработчики", 'job': "🗓️ Задачи", 'db': "💾 БД"}
+    response = "📊 Статистика с момента запуска:\n"
+    for kind, title in sections.items():
+        rows = [(name, h) for (metric, _, name), h in metrics.histograms.items()
+                if metric == f"bot_{kind}_duration_seconds"]
+        if not rows:
+            continue
+        response += f"\n{title}:\n"
+        for name, histogram in sorted(rows, key=lambda row: row[1].sum, reverse=True):
+            errors = metrics.counters.get((f"bot_{kind}_errors_total", kind, name), 0)
+            response += (
+                f"• {name}: {histogram.count} выз., ср. {histogram.sum / histogram.count * 1000:.1f} мс, "
+                f"p95 ≤ {histogram.quantile(0.95) * 1000:.0f} мс, макс {histogram.max * 1000:.0f} мс"
+                + (f", ошибок: {errors}" if errors else "") + "\n"
+            )
+    lag_rows = [(name, h) for (metric, _, name), h in metrics.histograms.items() if metric == "bot_job_lag_seconds"]
+    if lag_rows:
+        response += "\n⏱️ Опоздание задач:\n"
+        for name, histogram in sorted(lag_rows):
+            response += f"• {name}: ср. {histogram.sum / histogram.count:.2f} с, макс {histogram.max:.2f} с\n"
+    await update.message.reply_text(response)
+
+
+@instrumented('handler')
 async def rate_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message.reply_to_message:
         await update.message.reply_text("Чтобы оценить сообщение, используйте команду /rate в ответ на него.")
@@ -315,6 +1127,7 @@ async def rate_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await update.message.reply_text(response_text)
 
 
+@instrumented('handler')
 async def morning_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     if user_id not in ALLOWED_USER_IDS: return
@@ -322,6 +1135,7 @@ async def morning_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.reply_text("Утреннее приветствие отправлено в целевой чат.")
 
 
+@instrumented('handler')
 async def vk_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     if user_id not in ALLOWED_USER_IDS: return
@@ -335,10 +1149,60 @@ async def vk_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     for name, community_id in VK_COMMUNITIES.items():
         button = InlineKeyboardButton(name, callback_data=f"vk_post_{community_id}")
         keyboard.append([button])
+    if len(VK_COMMUNITIES) > 1:
+        keyboard.append([InlineKeyboardButton("📚 Все сообщества", callback_data="vk_post_all")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text("Выберите сообщество для постинга:", reply_markup=reply_markup)
 
 
+async def send_vk_photos(context: ContextTypes.DEFAULT_TYPE, chat_id: int, community_id: int,
+                         photos: list[tuple[str, str]]) -> None:
+    """Отправляет фото альбомом и запоминает их, чтобы не присылать повторно."""
+    # Сюда приходят только еще не виденные фото, поэтому в кэше file_id их быть не может - отправляем по URL.
+    media_group = [InputMediaPhoto(media=url) for _, url in photos]
+    messages = await context.bot.send_media_group(chat_id=chat_id, media=media_group)
+    # Кэш file_id нужен только кнопке "В очередь": она ставит эти фото в очередь без повторной загрузки.
+    await cache_vk_file_ids([(photo_key, message.photo[-1].file_id, message.photo[-1].file_unique_id)
+                             for (photo_key, _), message in zip(photos, messages) if message.photo])
+    await mark_vk_photos_seen(community_id, photos)
+    context.user_data.setdefault('vk_batch', []).extend(photo_key for photo_key, _ in photos)
+
+
+def vk_queue_markup(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
+    channel = current_channel(context)
+    return InlineKeyboardMarkup([[InlineKeyboardButton(f"➕ В очередь: {channel.name}", callback_data='vk_queue')]])
+
+
+@instrumented('handler')
+async def vk_queue_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ставит присланные из VK фото в очередь текущего канала по сохраненным file_id."""
+    query = update.callback_query
+    await query.answer()
+    channel = current_channel(context)
+    photo_keys = context.user_data.pop('vk_batch', [])
+    cached = await get_vk_file_ids(photo_keys)
+    posts = []
+    for photo_key in photo_keys:
+        if photo_key not in cached:
+            continue
+        file_id, file_unique_id = cached[photo_key]
+        if any(post['file_unique_id'] == file_unique_id for post in posts) \
+                or await find_duplicate(channel.chat_id, file_unique_id):
+            continue
+        posts.append({'id': str(uuid.uuid4()), 'channel_id': channel.chat_id, 'type': 'photo',
+                      'file_id': file_id, 'file_unique_id': file_unique_id, 'caption': None})
+    if not posts:
+        await query.edit_message_text("Нечего добавлять: эти фото уже в очереди или были опубликованы.")
+        return
+    await add_posts_to_db(posts)
+    await query.edit_message_text(
+        f"Добавлено фото из VK в очередь канала {channel.name}: {len(posts)}. "
+        f"Всего в очереди: {await count_posts_in_db(channel.chat_id)}."
+    )
+    await recalculate_channel(context, channel)
+
+
+@instrumented('handler')
 async def vk_community_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -347,25 +1211,55 @@ async def vk_community_selected(update: Update, context: ContextTypes.DEFAULT_TY
     except (ValueError, IndexError):
         await query.edit_message_text("Ошибка: неверный ID сообщества.")
         return
-    await query.edit_message_text("⏳ Ищу последние 10 фото, пожалуйста, подождите...")
-    photo_urls = await fetch_vk_photos(community_id, count=10)
-    if not photo_urls:
-        await query.edit_message_text("Не удалось найти фотографии в последних постах этого сообщества.")
+    await query.edit_message_text(f"⏳ Ищу {VK_PHOTOS_PER_COMMUNITY} новых фото, пожалуйста, подождите...")
+    context.user_data.pop('vk_batch', None)
+    photos = await fetch_vk_photos(community_id)
+    if not photos:
+        await query.edit_message_text("Не удалось найти новые фотографии в постах этого сообщества.")
         return
-    media_group = [InputMediaPhoto(media=url) for url in photo_urls]
     try:
-        await context.bot.send_media_group(chat_id=query.message.chat_id, media=media_group)
+        await send_vk_photos(context, query.message.chat_id, community_id, photos)
         await query.delete_message()
-        await context.bot.send_message(chat_id=query.message.chat_id, text=f"✅ Вот последние {len(photo_urls)} фото.")
+        await context.bot.send_message(chat_id=query.message.chat_id, text=f"✅ Вот {len(photos)} новых фото.",
+                                       reply_markup=vk_queue_markup(context))
     except Exception as e:
-        logger.error(f"Не удалось отправить медиа-группу: {e}")
+        logger.error("Не удалось отправить медиа-группу: %s", e)
         await query.edit_message_text(f"Произошла ошибка при отправке: {e}")
 
 
+@instrumented('handler')
+async def vk_all_communities_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    await query.edit_message_text("⏳ Ищу новые фото во всех сообществах, пожалуйста, подождите...")
+    context.user_data.pop('vk_batch', None)
+    results = await fetch_vk_photos_from_all(list(VK_COMMUNITIES.values()))
+    sent_count = 0
+    for (name, community_id), photos in zip(VK_COMMUNITIES.items(), results):
+        if not photos:
+            continue
+        try:
+            await send_vk_photos(context, query.message.chat_id, community_id, photos)
+            sent_count += len(photos)
+        except Exception as e:
+            logger.error("Не удалось отправить медиа-группу сообщества %s: %s", name, e)
+    if not sent_count:
+        await query.edit_message_text("Новых фотографий в сообществах не найдено.")
+        return
+    await query.delete_message()
+    await context.bot.send_message(chat_id=query.message.chat_id, text=f"✅ Вот {sent_count} новых фото из сообществ.",
+                                   reply_markup=vk_queue_markup(context))
+
+
 # --- ФУНКЦИИ ПРИВЕТСТВИЯ И СООБЩЕНИЙ ---
 
+@instrumented('job')
 async def send_daily_greeting(context: ContextTypes.DEFAULT_TYPE) -> None:
-    logger.info(f"Подготовка утреннего приветствия для чата {TARGET_CHAT_ID}")
+    # Между потерей аренды и паузой планировщика проходит до одного такта выбора лидера.
+    if not is_leader():
+        logger.warning("Реплика не держит аренду лидера, утреннее приветствие не отправляется.")
+        return
+    logger.info("Подготовка утреннего приветствия для чата %s", TARGET_CHAT_ID)
     now = datetime.now(MOSCOW_TZ)
     month_names = {
         1: "января", 2: "февраля", 3: "марта", 4: "апреля", 5: "мая", 6: "июня",
@@ -391,11 +1285,16 @@ async def send_daily_greeting(context: ContextTypes.DEFAULT_TYPE) -> None:
         await context.bot.send_message(chat_id=TARGET_CHAT_ID, text=final_message)
         logger.info("Утреннее приветствие успешно отправлено.")
     except Exception as e:
-        logger.error(f"Не удалось отправить утреннее приветствие в чат {TARGET_CHAT_ID}: {e}")
+        logger.error("Не удалось отправить утреннее приветствие в чат %s: %s", TARGET_CHAT_ID, e)
 
 
+@instrumented('job')
 async def send_and_reschedule_random_message(context: ContextTypes.DEFAULT_TYPE) -> None:
-    logger.info(f"Отправка случайного сообщения в чат {TARGET_CHAT_ID}")
+    if not is_leader():
+        # Следующее сообщение запланирует новый лидер при избрании.
+        logger.warning("Реплика не держит аренду лидера, случайное сообщение не отправляется.")
+        return
+    logger.info("Отправка случайного сообщения в чат %s", TARGET_CHAT_ID)
     if not RANDOM_MESSAGES:
         logger.warning("Список случайных сообщений пуст. Отправка отменена.")
         return
@@ -404,92 +1303,108 @@ async def send_and_reschedule_random_message(context: ContextTypes.DEFAULT_TYPE)
         await context.bot.send_message(chat_id=TARGET_CHAT_ID, text=message_to_send)
         logger.info("Случайное сообщение успешно отправлено.")
     except Exception as e:
-        logger.error(f"Не удалось отправить случайное сообщение в чат {TARGET_CHAT_ID}: {e}")
+        logger.error("Не удалось отправить случайное сообщение в чат %s: %s", TARGET_CHAT_ID, e)
     tomorrow = datetime.now(MOSCOW_TZ).date() + timedelta(days=1)
     random_hour = random.randint(10, 22)
     random_minute = random.randint(0, 59)
     random_time = time(hour=random_hour, minute=random_minute)
     next_run_datetime = datetime.combine(tomorrow, random_time).astimezone(MOSCOW_TZ)
-    context.job_queue.run_once(send_and_reschedule_random_message, when=next_run_datetime)
-    logger.info(f"Следующее случайное сообщение запланировано на {next_run_datetime.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+    context.job_queue.run_once(send_and_reschedule_random_message, when=next_run_datetime, name=RANDOM_MESSAGE_JOB)
+    logger.info("Следующее случайное сообщение запланировано на %s", next_run_datetime.strftime('%Y-%m-%d %H:%M:%S %Z'))
 
 
 # --- ФУНКЦИИ ДЛЯ ПОСТИНГА ---
-async def post_good_morning(context: ContextTypes.DEFAULT_TYPE):
-    global last_post_time
-    post_data = get_special_post('good_morning')
+async def remember_post_time(channel_id: str):
+    now = datetime.now(MOSCOW_TZ)
+    last_post_times[channel_id] = now
+    await save_bot_state(f'last_post_time:{channel_id}', now.isoformat())
+
+
+async def publish_special_post(channel: Channel, post_type: str, label: str):
+    if not is_leader():
+        logger.warning("Реплика не держит аренду лидера, %s пост канала %s не публикуется.", label, channel.name)
+        return
+    post_data = get_special_post(channel.chat_id, post_type)
     if not post_data:
-        logger.info("Нет запланированного утреннего поста для публикации.")
+        logger.info("Нет запланированного %s поста для канала %s.", label, channel.name)
         return
-    logger.info("Публикую утренний пост из БД...")
+    logger.info("Публикую %s пост в канал %s...", label, channel.name)
     try:
-        if post_data['type'] == 'photo':
-            await context.bot.send_photo(chat_id=CHANNEL_ID, photo=post_data['file_id'], caption=post_data['caption'])
-        elif post_data['type'] == 'video':
-            await context.bot.send_video(chat_id=CHANNEL_ID, video=post_data['file_id'], caption=post_data['caption'])
-        elif post_data['type'] == 'animation':
-            await context.bot.send_animation(chat_id=CHANNEL_ID, animation=post_data['file_id'],
-                                             caption=post_data['caption'])
-        now = datetime.now(MOSCOW_TZ)
-        last_post_time = now
-        save_bot_state('last_post_time', now.isoformat())
-        delete_special_post('good_morning')
-        logger.info("Утренний пост успешно опубликован и удален из БД.")
+        await publisher.publish(channel.chat_id, post_data)
+        await remember_post_time(channel.chat_id)
+        await delete_special_post(channel.chat_id, post_type)
+        logger.info("Пост '%s' канала %s успешно опубликован и удален из БД.", post_type, channel.name)
     except Exception as e:
-        logger.error(f"Не удалось опубликовать утренний пост: {e}")
+        if not maybe_delivered(e):
+            logger.error("Не удалось опубликовать %s пост в канал %s: %s", label, channel.name, e)
+            return
+        # Как и для обычных постов: повторная отправка на следующий день могла бы его продублировать.
+        logger.warning("Таймаут при публикации %s поста в канал %s, пост считается опубликованным: %s",
+                       label, channel.name, e)
+        await remember_post_time(channel.chat_id)
+        await delete_special_post(channel.chat_id, post_type)
+
+
+@instrumented('job')
+async def post_good_morning(context: ContextTypes.DEFAULT_TYPE):
+    await publish_special_post(CHANNELS_BY_ID[context.job.data], 'good_morning', "утреннего")
 
 
+@instrumented('job')
 async def post_good_night(context: ContextTypes.DEFAULT_TYPE):
-    global last_post_time
-    post_data = get_special_post('good_night')
-    if not post_data:
-        logger.info("Нет запланированного вечернего поста для публикации.")
-        return
-    logger.info("Публикую вечерний пост из БД...")
-    try:
-        if post_data['type'] == 'photo':
-            await context.bot.send_photo(chat_id=CHANNEL_ID, photo=post_data['file_id'], caption=post_data['caption'])
-        elif post_data['type'] == 'video':
-            await context.bot.send_video(chat_id=CHANNEL_ID, video=post_data['file_id'], caption=post_data['caption'])
-        elif post_data['type'] == 'animation':
-            await context.bot.send_animation(chat_id=CHANNEL_ID, animation=post_data['file_id'],
-                                             caption=post_data['caption'])
-        now = datetime.now(MOSCOW_TZ)
-        last_post_time = now
-        save_bot_state('last_post_time', now.isoformat())
-        delete_special_post('good_night')
-        logger.info("Вечерний пост успешно опубликован и удален из БД.")
-    except Exception as e:
-        logger.error(f"Не удалось опубликовать вечерний пост: {e}")
+    await publish_special_post(CHANNELS_BY_ID[context.job.data], 'good_night', "вечернего")
 
 
+@instrumented('job')
 async def post_normal_meme(context: ContextTypes.DEFAULT_TYPE):
-    global last_post_time
-    post_data = context.job.data
-    logger.info(f"Публикую обычный пост {post_data['id']}.")
-    caption = post_data.get('caption')
+    channel_id, post_id = context.job.data['channel_id'], context.job.data['post_id']
+    log_fields = {'post_id': post_id, 'channel_id': channel_id, 'job': context.job.name}
+    scheduler_for(channel_id).forget(post_id)
+    if not is_leader():
+        logger.warning("Реплика не держит аренду лидера, пост %s не публикуется.", post_id, extra=log_fields)
+        return
+    post_data = await get_post(post_id)
+    if not post_data:
+        logger.info("Пост %s уже удален из очереди, публикация пропущена.", post_id, extra=log_fields)
+        return
+    posts = [post_data]
+    if ALBUM_BACKLOG_THRESHOLD and len(order_for(channel_id)) > ALBUM_BACKLOG_THRESHOLD:
+        posts = await get_album_posts(channel_id, post_data)
+    post_ids = [post['id'] for post in posts]
+    logger.debug("Публикую обычный пост %s в канал %s (медиа: %d).", post_id, channel_id, len(posts),
+                 extra=log_fields)
     try:
-        if post_data['type'] == 'photo':
-            await context.bot.send_photo(chat_id=CHANNEL_ID, photo=post_data['file_id'], caption=caption)
-        elif post_data['type'] == 'video':
-            await context.bot.send_video(chat_id=CHANNEL_ID, video=post_data['file_id'], caption=caption)
-        elif post_data['type'] == 'animation':
-            await context.bot.send_animation(chat_id=CHANNEL_ID, animation=post_data['file_id'], caption=caption)
-        delete_post_from_db(post_data['id'])
-        now = datetime.now(MOSCOW_TZ)
-        last_post_time = now
-        save_bot_state('last_post_time', now.isoformat())
-        logger.info(f"Обычный пост {post_data['id']} успешно опубликован и удален из БД.")
+        if len(posts) > 1:
+            await publisher.publish_album(channel_id, posts)
+        else:
+            await publisher.publish(channel_id, post_data)
+        await archive_posts(channel_id, post_ids)
+        await remember_post_time(channel_id)
+        logger.info("Обычный пост %s успешно опубликован и удален из БД (медиа: %d).", post_id, len(posts),
+                    extra={**log_fields, 'album': post_ids} if len(posts) > 1 else log_fields)
     except Exception as e:
-        logger.error(f"Не удалось опубликовать обычный пост {post_data['id']}: {e}")
+        if not maybe_delivered(e):
+            logger.error("Не удалось опубликовать обычный пост %s: %s", post_id, e, extra=log_fields)
+            return
+        # Неизвестно, дошел ли пост до канала; убираем его из очереди, чтобы не опубликовать дважды.
+        logger.warning("Таймаут при публикации поста %s, пост считается опубликованным: %s", post_id, e,
+                       extra=log_fields)
+        await archive_posts(channel_id, post_ids)
+        await remember_post_time(channel_id)
+    # План держит только PLAN_HORIZON задач: освободившееся место занимает следующий пост очереди.
+    # Альбом занимает один слот, поэтому слоты ушедших в него постов тоже переходят следующим.
+    channel = CHANNELS_BY_ID.get(channel_id)
+    if channel and (len(posts) > 1 or len(order_for(channel_id)) > len(scheduler_for(channel_id).plan)):
+        await recalculate_channel(context, channel)
 
 
 # --- ОБРАБОТЧИКИ КОМАНД И КНОПОК ---
 
+@instrumented('handler')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     if user_id not in ALLOWED_USER_IDS:
-        logger.warning(f"Попытка несанкционированного доступа от user_id: {user_id}")
+        logger.warning("Попытка несанкционированного доступа от user_id: %s", user_id)
         return
     if update.message and update.message.chat.type in ['group', 'supergroup']:
         await update.message.reply_text("Для управления ботом, пожалуйста, напишите мне в личные сообщения.")
@@ -504,12 +1419,28 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text(text, reply_markup=reply_markup)
 
 
+PRIORITY_LABELS = {PRIORITIES['urgent']: "🔥 Срочный", PRIORITIES['normal']: "📌 Обычный",
+                   PRIORITIES['filler']: "💤 Филлер"}
+
+
+def current_channel(context: ContextTypes.DEFAULT_TYPE) -> Channel:
+    """Канал, с которым сейчас работает администратор; по умолчанию первый из CHANNELS."""
+    return CHANNELS_BY_ID.get(context.user_data.get('channel_id'), CHANNELS[0])
+
+
+@instrumented('handler')
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    if query.data == 'post_meme':
-        gm_scheduled = get_special_post('good_morning') is not None
-        gn_scheduled = get_special_post('good_night') is not None
+    action = query.data
+    if action.startswith('channel_'):
+        context.user_data['channel_id'] = CHANNELS[int(action.split('_')[-1])].chat_id
+        action = 'post_meme'
+    if action == 'post_meme':
+        context.user_data.pop('post_type', None)
+        channel = current_channel(context)
+        gm_scheduled = get_special_post(channel.chat_id, 'good_morning') is not None
+        gn_scheduled = get_special_post(channel.chat_id, 'good_night') is not None
         gm_text = "Доброе утро! ✅" if gm_scheduled else "Доброе утро!"
         gn_text = "Спокойной ночи! ✅" if gn_scheduled else "Спокойной ночи!"
         keyboard = [
@@ -517,19 +1448,27 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             [InlineKeyboardButton(gn_text, callback_data='good_night')],
             [InlineKeyboardButton("Обычный постинг", callback_data='normal_post')],
             [InlineKeyboardButton("👀 Просмотр очереди", callback_data='view_queue_0')],
-            [InlineKeyboardButton("⬅️ Назад", callback_data='start')]
         ]
+        if len(CHANNELS) > 1:
+            keyboard.append([InlineKeyboardButton("🔀 Сменить канал", callback_data='choose_channel')])
+        keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data='start')])
         reply_markup = InlineKeyboardMarkup(keyboard)
+        text = f"Канал: {channel.name}\nВыбери тип поста:" if len(CHANNELS) > 1 else "Выбери тип поста:"
         try:
-            await query.edit_message_text(text="Выбери тип поста:", reply_markup=reply_markup)
+            await query.edit_message_text(text=text, reply_markup=reply_markup)
         except BadRequest as e:
             if 'no text in the message to edit' in str(e).lower():
                 await query.message.delete()
-                await query.message.chat.send_message(text="Выбери тип поста:", reply_markup=reply_markup)
+                await query.message.chat.send_message(text=text, reply_markup=reply_markup)
             else:
-                logger.error(f"Неожиданная ошибка BadRequest при возврате в меню: {e}")
-    elif query.data in ['good_morning', 'good_night', 'normal_post']:
-        context.user_data['post_type'] = query.data
+                logger.error("Неожиданная ошибка BadRequest при возврате в меню: %s", e)
+    elif action == 'choose_channel':
+        keyboard = [[InlineKeyboardButton(channel.name, callback_data=f'channel_{i}')]
+                    for i, channel in enumerate(CHANNELS)]
+        keyboard.append([InlineKeyboardButton("⬅️ Назад в меню", callback_data='post_meme')])
+        await query.edit_message_text(text="Выбери канал:", reply_markup=InlineKeyboardMarkup(keyboard))
+    elif action in ['good_morning', 'good_night', 'normal_post']:
+        context.user_data['post_type'] = action
         text_map = {
             'good_morning': "Отправь медиа для утреннего поста. Текст, который ты добавишь к медиа, будет опубликован над основной подписью.",
             'good_night': "Отправь медиа для вечернего поста. Текст, который ты добавишь к медиа, будет опубликован над основной подписью.",
@@ -537,9 +1476,10 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         }
         back_button_keyboard = [[InlineKeyboardButton("⬅️ Назад в меню", callback_data='post_meme')]]
         reply_markup = InlineKeyboardMarkup(back_button_keyboard)
-        await query.edit_message_text(text=text_map[query.data], reply_markup=reply_markup)
+        await query.edit_message_text(text=text_map[action], reply_markup=reply_markup)
 
 
+@instrumented('handler')
 async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not context.user_data: return
     post_type = context.user_data.get('post_type')
@@ -557,37 +1497,91 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await message.reply_text("Пожалуйста, отправь фото, видео или гифку.")
         return
 
-    post_data = {'type': file_type, 'file_id': media_file.file_id}
+    channel = current_channel(context)
+    post_data = {'type': file_type, 'file_id': media_file.file_id, 'file_unique_id': media_file.file_unique_id}
     back_to_menu_markup = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад в меню", callback_data='post_meme')]])
     user_caption = message.caption
 
     if post_type == 'good_morning':
         bot_greeting = "Доброе утро!"
         post_data['caption'] = f"{user_caption}\n\n{bot_greeting}" if user_caption else bot_greeting
-        save_or_update_special_post('good_morning', post_data)
-        await message.reply_text("Утренний пост на 10:00 сохранен! 💛", reply_markup=back_to_menu_markup)
-        context.user_data.clear()
+        await save_or_update_special_post(channel.chat_id, 'good_morning', post_data)
+        await message.reply_text(f"Утренний пост на {channel.start_hour}:00 сохранен! 💛", reply_markup=back_to_menu_markup)
+        context.user_data.pop('post_type', None)
 
     elif post_type == 'good_night':
         bot_greeting = "Спокойной ночи!"
         post_data['caption'] = f"{user_caption}\n\n{bot_greeting}" if user_caption else bot_greeting
-        save_or_update_special_post('good_night', post_data)
-        await message.reply_text("Вечерний пост на 23:00 сохранен! 💛", reply_markup=back_to_menu_markup)
-        context.user_data.clear()
+        await save_or_update_special_post(channel.chat_id, 'good_night', post_data)
+        await message.reply_text(f"Вечерний пост на {channel.end_hour}:00 сохранен! 💛", reply_markup=back_to_menu_markup)
+        context.user_data.pop('post_type', None)
 
     elif post_type == 'normal_post':
+        # Режим остается активным: медиа копятся в буфере и сохраняются пачкой, когда альбом закончится.
+        if PHASH_ENABLED and file_type == 'photo':
+            post_data['phash'] = await photo_hash(context.bot, message.photo)
+        duplicate = await find_duplicate(channel.chat_id, media_file.file_unique_id, post_data.get('phash'))
+        # Буфер берется только после await: пока шла проверка, flush_pending_posts мог его уже забрать.
+        pending_posts = context.user_data.setdefault('pending_posts', [])
+        if not duplicate and any(pending['file_unique_id'] == media_file.file_unique_id for pending in pending_posts):
+            duplicate = 'queued'
+        if duplicate:
+            text = "Этот мем уже в очереди." if duplicate == 'queued' else "Этот мем уже публиковался в канале."
+            await message.reply_text(f"{text} Повторно не добавляю.", do_quote=True)
+            logger.info("Дубликат %s (%s) не добавлен в очередь %s.", media_file.file_unique_id, duplicate, channel.name,
+                        extra={'file_unique_id': media_file.file_unique_id, 'channel_id': channel.chat_id})
+            return
         post_data['id'] = str(uuid.uuid4())
+        post_data['channel_id'] = channel.chat_id
         post_data['caption'] = user_caption
-        add_post_to_db(post_data)
-        await message.reply_text(
-            f"Мем добавлен в очередь. Всего в очереди: {count_posts_in_db()}.",
-            reply_markup=back_to_menu_markup
+        pending_posts.append(post_data)
+        # Таймер - обычная задача, а не JobQueue: на ведомой реплике планировщик стоит на паузе.
+        flush_task = context.user_data.get('flush_task')
+        if flush_task:
+            flush_task.cancel()
+        context.user_data['flush_task'] = context.application.create_task(
+            flush_after_debounce(context, message.chat_id), update=update,
+            name=f"flush_posts_{update.effective_user.id}"
         )
-        await recalculate_and_schedule_all_posts(context)
-        context.user_data.clear()
+
+
+async def flush_after_debounce(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
+    await asyncio.sleep(MEDIA_GROUP_DEBOUNCE)
+    # Дальше задачу уже нельзя отменить новым медиа: буфер забирается и сохраняется целиком.
+    context.user_data.pop('flush_task', None)
+    await flush_pending_posts(context, chat_id)
+
+
+@instrumented('handler')
+async def flush_pending_posts(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
+    """Сохраняет накопленные медиа одной транзакцией и перепланирует очередь один раз."""
+    posts = context.user_data.pop('pending_posts', [])
+    if not posts:
+        return
+    try:
+        await add_posts_to_db(posts)
+    except Exception as e:
+        logger.error("Не удалось сохранить в очередь %d постов: %s", len(posts), e)
+        await context.bot.send_message(
+            chat_id=chat_id, text=f"Не удалось добавить мемы в очередь ({len(posts)} шт.), пришлите их еще раз."
+        )
+        return
+    logger.info("В очередь добавлено постов: %d.", len(posts))
+    added_text = "Мем добавлен в очередь." if len(posts) == 1 else f"Добавлено мемов в очередь: {len(posts)}."
+    back_to_menu_markup = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад в меню", callback_data='post_meme')]])
+    channel = CHANNELS_BY_ID[posts[-1]['channel_id']]
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=f"{added_text} Всего в очереди: {await count_posts_in_db(channel.chat_id)}.",
+        reply_markup=back_to_menu_markup
+    )
+    # Пока шел альбом, администратор мог сменить канал, поэтому перепланируем каждый затронутый.
+    for channel_id in dict.fromkeys(post_data['channel_id'] for post_data in posts):
+        await recalculate_channel(context, CHANNELS_BY_ID[channel_id])
 
 
 # --- ФУНКЦИИ ДЛЯ ПРОСМОТРА И УДАЛЕНИЯ ---
+@instrumented('handler')
 async def show_queue_item(update: Update, context: ContextTypes.DEFAULT_TYPE, index: int = None) -> None:
     query = update.callback_query
     await query.answer()
@@ -598,8 +1592,9 @@ async def show_queue_item(update: Update, context: ContextTypes.DEFAULT_TYPE, in
         except (ValueError, IndexError):
             await query.edit_message_text("Ошибка: неверный индекс.")
             return
-    posts_in_queue = get_all_posts_from_db()
-    if not posts_in_queue:
+    channel = current_channel(context)
+    total_posts = await count_posts_in_db(channel.chat_id)
+    if not total_posts:
         try:
             await query.message.delete()
         except BadRequest:
@@ -609,20 +1604,37 @@ async def show_queue_item(update: Update, context: ContextTypes.DEFAULT_TYPE, in
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад в меню", callback_data='post_meme')]])
         )
         return
-    current_index = max(0, min(current_index, len(posts_in_queue) - 1))
-    post_data = posts_in_queue[current_index]
+    current_index = max(0, min(current_index, total_posts - 1))
+    post_data = await get_post_at(channel.chat_id, current_index)
+    if post_data is None:
+        # Порядок в памяти разошелся с БД (пост удалили в другом месте) - перечитываем его.
+        await load_state_cache()
+        total_posts = await count_posts_in_db(channel.chat_id)
+        current_index = max(0, min(current_index, total_posts - 1))
+        post_data = await get_post_at(channel.chat_id, current_index) if total_posts else None
+    if post_data is None:
+        await query.message.chat.send_message(
+            "Очередь изменилась, откройте ее заново.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад в меню", callback_data='post_meme')]])
+        )
+        return
     post_id = post_data['id']
     keyboard = []
     nav_buttons = []
     if current_index > 0:
         nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'view_queue_{current_index - 1}'))
     nav_buttons.append(InlineKeyboardButton("❌ Удалить", callback_data=f'delete_{post_id}_{current_index}'))
-    if current_index < len(posts_in_queue) - 1:
+    if current_index < total_posts - 1:
         nav_buttons.append(InlineKeyboardButton("➡️ Вперед", callback_data=f'view_queue_{current_index + 1}'))
     keyboard.append(nav_buttons)
+    keyboard.append([InlineKeyboardButton(label, callback_data=f'prio_{post_id}_{priority}')
+                     for priority, label in PRIORITY_LABELS.items() if priority != post_data['priority']])
     keyboard.append([InlineKeyboardButton("⬅️ Назад в меню", callback_data='post_meme')])
     reply_markup = InlineKeyboardMarkup(keyboard)
-    caption = f"Пост {current_index + 1} из {len(posts_in_queue)}"
+    caption = f"Пост {current_index + 1} из {total_posts}"
+    if len(CHANNELS) > 1:
+        caption += f" ({channel.name})"
+    caption += f"\nПриоритет: {PRIORITY_LABELS[post_data['priority']]}"
     user_caption = post_data.get('caption')
     if user_caption:
         caption += f"\n\n---\n{user_caption}"
@@ -640,17 +1652,32 @@ async def show_queue_item(update: Update, context: ContextTypes.DEFAULT_TYPE, in
             pass
         else:
             await query.delete_message()
-            if media_type == 'photo':
-                await context.bot.send_photo(chat_id=query.message.chat_id, photo=file_id, caption=caption,
-                                             reply_markup=reply_markup)
-            elif media_type == 'video':
-                await context.bot.send_video(chat_id=query.message.chat_id, video=file_id, caption=caption,
-                                             reply_markup=reply_markup)
-            elif media_type == 'animation':
-                await context.bot.send_animation(chat_id=query.message.chat_id, animation=file_id, caption=caption,
-                                                 reply_markup=reply_markup)
+            await send_media(context.bot, query.message.chat_id, post_data, caption=caption, reply_markup=reply_markup)
+
+
+@instrumented('handler')
+async def change_priority_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Меняет приоритет поста и показывает его уже на новом месте в очереди."""
+    query = update.callback_query
+    try:
+        _, post_id, priority_str = query.data.split('_')
+        priority = int(priority_str)
+    except ValueError:
+        await query.answer("Ошибка при смене приоритета.", show_alert=True)
+        return
+    channel = current_channel(context)
+    index = await set_post_priority(channel.chat_id, post_id, priority)
+    if index is None:
+        # Кнопка могла остаться от очереди другого канала: чужой пост не должен попасть в порядок этого.
+        await query.answer("Этого поста уже нет в очереди выбранного канала.", show_alert=True)
+        return
+    logger.info("Приоритет поста %s изменен на %s, новое место в очереди: %d.", post_id, priority, index + 1,
+                extra={'post_id': post_id})
+    await recalculate_channel(context, channel)
+    await show_queue_item(update, context, index=index)
 
 
+@instrumented('handler')
 async def delete_queue_item(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -660,33 +1687,215 @@ async def delete_queue_item(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except ValueError:
         await query.answer("Ошибка при удалении.", show_alert=True)
         return
-    delete_post_from_db(post_id_to_delete)
-    logger.info(f"Пост с ID {post_id_to_delete} удален из очереди.")
-    await recalculate_and_schedule_all_posts(context)
+    channel_id = await delete_post_from_db(post_id_to_delete)
+    if channel_id is not None:
+        # Канал берется из самой записи: кнопка могла остаться от очереди другого канала.
+        channel = CHANNELS_BY_ID.get(channel_id, current_channel(context))
+        logger.info("Пост с ID %s удален из очереди канала %s.", post_id_to_delete, channel.name,
+                    extra={'post_id': post_id_to_delete})
+        await recalculate_channel(context, channel)
     await show_queue_item(update, context, index=index)
 
 
-def main() -> None:
-    setup_database()
-    global bot_startup_time, last_post_time
-    bot_startup_time = datetime.now(MOSCOW_TZ)
-    last_post_time_str = get_bot_state('last_post_time')
-    if last_post_time_str:
-        last_post_time = datetime.fromisoformat(last_post_time_str)
-        logger.info(f"Восстановлено время последнего поста: {last_post_time.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+async def find_results(context: ContextTypes.DEFAULT_TYPE, offset: int) -> tuple[str, InlineKeyboardMarkup]:
+    """Страница результатов поиска из user_data['find']: кнопка на каждый пост, фильтр типа и листание."""
+    search = context.user_data['find']
+    channel = current_channel(context)
+    rows = await search_captions(channel.chat_id, search['query'], search['type'], offset, FIND_PAGE_SIZE + 1)
+    has_next = len(rows) > FIND_PAGE_SIZE
+    keyboard = []
+    for row in rows[:FIND_PAGE_SIZE]:
+        caption = row['caption'] if len(row['caption']) <= 40 else row['caption'][:39] + "…"
+        if row['source'] == 'queue':
+            label, callback_data = f"{MEDIA_LABELS[row['type']]}: {caption}", f"find_open_{row['item_id']}"
+        else:
+            label, callback_data = f"✅ {caption}", f"find_hist_{row['item_id']}"
+        keyboard.append([InlineKeyboardButton(label, callback_data=callback_data)])
+    keyboard.append([
+        InlineKeyboardButton(("• " if search['type'] == media_type else "") + label,
+                             callback_data=f"find_type_{media_type or 'all'}")
+        for media_type, label in [(None, "Все"), *MEDIA_LABELS.items()]
+    ])
+    nav_buttons = []
+    if offset > 0:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"find_page_{max(0, offset - FIND_PAGE_SIZE)}"))
+    if has_next:
+        nav_buttons.append(InlineKeyboardButton("➡️ Вперед", callback_data=f"find_page_{offset + FIND_PAGE_SIZE}"))
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+    if rows:
+        text = f"Поиск «{search['text']}» ({channel.name}), результаты с {offset + 1}:\n✅ - уже опубликован."
+    else:
+        text = f"По запросу «{search['text']}» в канале {channel.name} ничего не найдено."
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+@instrumented('handler')
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    if user_id not in ALLOWED_USER_IDS: return
+    if update.message.chat.type in ['group', 'supergroup']:
+        await update.message.reply_text("Эта команда доступна только в личных сообщениях с ботом.")
+        return
+    args = list(context.args)
+    media_type = FIND_TYPE_ALIASES.get(args[0].lower()) if args else None
+    if media_type:
+        args = args[1:]
+    text = " ".join(args)
+    query = fts_query(text)
+    if not query:
+        await update.message.reply_text("Использование: /find [фото|видео|гиф] <текст подписи>")
+        return
+    context.user_data['find'] = {'query': query, 'text': text, 'type': media_type}
+    text, reply_markup = await find_results(context, 0)
+    await update.message.reply_text(text, reply_markup=reply_markup)
 
-    logger.info(f"Бот запущен в {bot_startup_time.strftime('%Y-%m-%d %H:%M:%S %Z')}")
 
-    application = Application.builder().token(BOT_TOKEN).build()
-    application.job_queue.run_once(recalculate_and_schedule_all_posts, when=2, name="initial_recalculator")
+@instrumented('handler')
+async def find_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    search = context.user_data.get('find')
+    if search is None:
+        await query.answer("Поиск устарел, повторите /find.", show_alert=True)
+        return
+    action, _, value = query.data.removeprefix('find_').partition('_')
+    if action == 'open':
+        index = order_for(current_channel(context).chat_id).index(value)
+        if index is None:
+            await query.answer("Пост уже опубликован или удален.", show_alert=True)
+            return
+        await show_queue_item(update, context, index=index)
+        return
+    await query.answer()
+    if action == 'hist':
+        post_data = await get_posted_media(int(value))
+        if not post_data or not post_data['file_id']:
+            await query.message.reply_text("Медиа этого поста не сохранилось.")
+            return
+        caption = f"Опубликован {post_data['posted_at']}"
+        if post_data['caption']:
+            caption += f"\n\n---\n{post_data['caption']}"
+        await send_media(context.bot, query.message.chat_id, post_data, caption=caption)
+        return
+    offset = 0
+    if action == 'type':
+        search['type'] = None if value == 'all' else value
+    elif action == 'page':
+        offset = int(value)
+    text, reply_markup = await find_results(context, offset)
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        if 'message is not modified' not in str(e).lower():
+            raise
+
+
+async def post_init(application: Application) -> None:
+    global metrics_server
+    metrics.watch_job_lag(application.job_queue.scheduler)
+    if METRICS_PORT:
+        metrics_server = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    await start_http_client(http2=HTTP2_ENABLED)
+    publisher.start(application.bot)
+    await setup_database()
+    restore_last_post_times()
+    if LEADER_ELECTION_ENABLED:
+        await start_leader_election(application)
+
+
+def is_leader() -> bool:
+    return leader_election is None or leader_election.has_lease()
+
+
+async def start_leader_election(application: Application) -> None:
+    """Задачи стоят на паузе, пока реплика не получит аренду; ведомая реплика только перечитывает кэш."""
+    global leader_election
+    job_queue = application.job_queue
+    # JobQueue.start() не трогает уже запущенный планировщик, поэтому он так и останется на паузе.
+    job_queue.scheduler.start(paused=True)
+
+    async def on_elected():
+        await load_state_cache()
+        restore_last_post_times()
+        if not job_queue.get_jobs_by_name(RANDOM_MESSAGE_JOB):
+            schedule_first_random_message(job_queue)
+        job_queue.run_once(restore_schedule, when=0, name="schedule_restorer")
+        job_queue.scheduler.resume()
+
+    async def on_demoted():
+        job_queue.scheduler.pause()
+        # Задачи обычных постов пересоздаст restore_schedule из сохраненного плана, если лидерство вернется.
+        for scheduler in post_schedulers.values():
+            scheduler.clear()
+
+    async def on_follow():
+        if await queue_revision_changed():
+            await load_state_cache()
+
+    if BOT_MODE != 'webhook':
+        logger.warning("Выбор лидера включен в режиме polling: Telegram отдает обновления только одной реплике.")
+    leader_election = LeaderElection(
+        db, REPLICA_ID, ttl=LEADER_LEASE_TTL, interval=LEADER_HEARTBEAT_INTERVAL,
+        on_elected=on_elected, on_demoted=on_demoted, on_follow=on_follow,
+    )
+    leader_election.start()
 
-    application.job_queue.run_daily(
-        post_good_morning, time=time(hour=10, minute=0, tzinfo=MOSCOW_TZ),
-        name='good_morning_job', job_kwargs=JOB_KWARGS
+
+async def post_shutdown(application: Application) -> None:
+    if leader_election is not None:
+        await leader_election.stop()
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    await publisher.stop()
+    shutdown_hash_pool()
+    await close_http_client()
+    await db.close()
+
+
+def update_lane(update: object):
+    """Очередь обновления: у каждого администратора своя, а долгие запросы к VK идут отдельной,
+    чтобы не задерживать загрузку мемов тем же администратором."""
+    key = user_key(update)
+    if key is not None and update.callback_query and (update.callback_query.data or '').startswith('vk_'):
+        return key, 'vk'
+    return key
+
+
+def schedule_first_random_message(job_queue) -> None:
+    now_in_tz = datetime.now(MOSCOW_TZ)
+    random_hour = random.randint(10, 22)
+    random_minute = random.randint(0, 59)
+    today_random_time = now_in_tz.replace(hour=random_hour, minute=random_minute, second=0, microsecond=0)
+    first_run_datetime = today_random_time if today_random_time > now_in_tz else today_random_time + timedelta(days=1)
+    job_queue.run_once(
+        send_and_reschedule_random_message, when=first_run_datetime, name=RANDOM_MESSAGE_JOB, job_kwargs=JOB_KWARGS
     )
+    logger.info("Первое случайное сообщение запланировано на %s", first_run_datetime.strftime('%Y-%m-%d %H:%M:%S %Z'))
+
+
+def build_application(bot=None) -> Application:
+    """Собирает приложение со всеми задачами и обработчиками. bot позволяет подставить заглушку."""
+    builder = Application.builder().post_init(post_init).post_shutdown(post_shutdown)
+    builder = builder.bot(bot) if bot else builder.token(BOT_TOKEN)
+    builder = builder.concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY, key=update_lane))
+    application = builder.build()
+    if not LEADER_ELECTION_ENABLED:
+        # С выбором лидера план восстанавливает реплика, получившая аренду.
+        application.job_queue.run_once(restore_schedule, when=2, name="schedule_restorer")
+
+    for channel in CHANNELS:
+        application.job_queue.run_daily(
+            post_good_morning, time=time(hour=channel.start_hour, minute=0, tzinfo=MOSCOW_TZ),
+            data=channel.chat_id, name=f'good_morning_job_{channel.chat_id}', job_kwargs=JOB_KWARGS
+        )
+        application.job_queue.run_daily(
+            post_good_night, time=time(hour=channel.end_hour, minute=0, tzinfo=MOSCOW_TZ),
+            data=channel.chat_id, name=f'good_night_job_{channel.chat_id}', job_kwargs=JOB_KWARGS
+        )
     application.job_queue.run_daily(
-        post_good_night, time=time(hour=23, minute=0, tzinfo=MOSCOW_TZ),
-        name='good_night_job', job_kwargs=JOB_KWARGS
+        prefetch_weather, time=time(hour=9, minute=55, tzinfo=MOSCOW_TZ),
+        name='weather_prefetch_job', job_kwargs=JOB_KWARGS
     )
     application.job_queue.run_daily(
         send_daily_greeting, time=time(hour=10, minute=0, tzinfo=MOSCOW_TZ),
@@ -696,31 +1905,211 @@ def main() -> None:
         recalculate_and_schedule_all_posts, time=time(hour=0, minute=1, tzinfo=MOSCOW_TZ),
         name='daily_recalculator', job_kwargs=JOB_KWARGS
     )
-
-    now_in_tz = datetime.now(MOSCOW_TZ)
-    random_hour = random.randint(10, 22)
-    random_minute = random.randint(0, 59)
-    today_random_time = now_in_tz.replace(hour=random_hour, minute=random_minute, second=0, microsecond=0)
-    first_run_datetime = today_random_time if today_random_time > now_in_tz else today_random_time + timedelta(days=1)
-    application.job_queue.run_once(
-        send_and_reschedule_random_message, when=first_run_datetime, job_kwargs=JOB_KWARGS
+    application.job_queue.run_repeating(
+        check_queue_revision, interval=QUEUE_REVISION_CHECK_INTERVAL, first=QUEUE_REVISION_CHECK_INTERVAL,
+        name='queue_revision_checker', job_kwargs=JOB_KWARGS
     )
-    logger.info(f"Первое случайное сообщение запланировано на {first_run_datetime.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+
+    schedule_first_random_message(application.job_queue)
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("rate", rate_message))
     application.add_handler(CommandHandler("jobs", show_jobs))
+    application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("morning", morning_command))
     application.add_handler(CommandHandler("vk", vk_command))
+    application.add_handler(CommandHandler("find", find_command))
     application.add_handler(CallbackQueryHandler(start, pattern='^start$'))
-    application.add_handler(CallbackQueryHandler(button, pattern='^(post_meme|good_morning|good_night|normal_post)$'))
+    application.add_handler(CallbackQueryHandler(button, pattern='^(post_meme|good_morning|good_night|normal_post|choose_channel|channel_\\d+)$'))
     application.add_handler(CallbackQueryHandler(show_queue_item, pattern='^view_queue_'))
     application.add_handler(CallbackQueryHandler(delete_queue_item, pattern='^delete_'))
+    application.add_handler(CallbackQueryHandler(change_priority_item, pattern='^prio_'))
+    application.add_handler(CallbackQueryHandler(vk_queue_selected, pattern='^vk_queue$'))
+    application.add_handler(CallbackQueryHandler(find_selected, pattern='^find_'))
+    application.add_handler(CallbackQueryHandler(vk_all_communities_selected, pattern='^vk_post_all$'))
     application.add_handler(CallbackQueryHandler(vk_community_selected, pattern='^vk_post_'))
     application.add_handler(MessageHandler(filters.PHOTO | filters.VIDEO | filters.ANIMATION, handle_media))
+    return application
+
+
+def main() -> None:
+    global bot_startup_time
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        # Без публичного адреса PTB зарегистрировал бы в Telegram http://0.0.0.0:... и апдейты бы не приходили.
+        logger.error("BOT_MODE=webhook требует WEBHOOK_URL - публичный https-адрес бота.")
+        raise SystemExit(1)
+    bot_startup_time = datetime.now(MOSCOW_TZ)
+    logger.info("Бот запущен в %s", bot_startup_time.strftime('%Y-%m-%d %H:%M:%S %Z'))
+
+    application = build_application()
+    if BOT_MODE == 'webhook':
+        webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        logger.info("Запуск в режиме webhook на %s:%s/%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=webhook_url,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        application.run_polling()
+
+
+# --- МАССОВЫЙ ИМПОРТ И ЭКСПОРТ ОЧЕРЕДИ ---
 
-    application.run_polling()
+def iter_import_items(source: str):
+    """Построчно читает описания постов из JSONL или перебирает медиафайлы каталога."""
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            stem, extension = os.path.splitext(os.path.join(source, name))
+            if extension.lower() not in MEDIA_EXTENSIONS:
+                continue
+            caption = None
+            # Подпись можно положить рядом в файл с тем же именем и расширением .txt
+            if os.path.exists(f"{stem}.txt"):
+                with open(f"{stem}.txt", encoding='utf-8') as f:
+                    caption = f.read().strip() or None
+            yield {'path': stem + extension, 'type': MEDIA_EXTENSIONS[extension.lower()], 'caption': caption}
+        return
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if item.get('path'):
+                item['path'] = os.path.join(base_dir, item['path'])
+                item.setdefault('type', MEDIA_EXTENSIONS.get(os.path.splitext(item['path'])[1].lower()))
+            yield item
+
+
+async def upload_local_file(uploader: Publisher, chat_id, path: str, file_type: str) -> dict:
+    """Один раз загружает файл в служебный чат, запоминает file_id и удаляет сообщение."""
+    message = await uploader.publish(chat_id, {'type': file_type, 'file_id': Path(path)}, disable_notification=True)
+    if message.animation:
+        media, file_type = message.animation, 'animation'
+    elif message.video:
+        media, file_type = message.video, 'video'
+    else:
+        media, file_type = message.photo[-1], 'photo'
+    try:
+        await message.delete()
+    except Exception as e:
+        logger.warning("Не удалось удалить служебное сообщение с %s: %s", path, e)
+    return {'type': file_type, 'file_id': media.file_id, 'file_unique_id': media.file_unique_id}
+
+
+async def import_queue(source: str, channel_id: str, upload_chat_id) -> int:
+    """Импортирует посты пачками по IMPORT_BATCH_SIZE, каждая пачка - одна транзакция.
+
+    Очередь в памяти не трогается: CLI работает отдельным процессом, а запущенный бот подхватит
+    новые посты по ревизии очереди.
+    """
+    imported, batch, bot = 0, [], None
+    uploader = Publisher(posts_per_minute=UPLOAD_POSTS_PER_MINUTE)
+    try:
+        for item in iter_import_items(source):
+            if item.get('path'):
+                if bot is None:
+                    bot = Bot(BOT_TOKEN)
+                    await bot.initialize()
+                    uploader.start(bot)
+                try:
+                    item.update(await upload_local_file(uploader, upload_chat_id, item['path'], item['type']))
+                except Exception as e:
+                    logger.error("Не удалось загрузить %s: %s", item['path'], e)
+                    continue
+            item_channel_id = str(item.get('channel_id') or channel_id)
+            if item.get('type') not in SEND_METHODS or not item.get('file_id') or item_channel_id not in CHANNELS_BY_ID:
+                logger.warning("Пропущена некорректная запись импорта: %s", item)
+                continue
+            priority = PRIORITIES.get(item.get('priority'), item.get('priority', DEFAULT_PRIORITY))
+            if priority not in PRIORITIES.values():
+                logger.warning("Неизвестный приоритет %s, пост импортирован как обычный.", priority)
+                priority = DEFAULT_PRIORITY
+            batch.append({
+                'id': str(uuid.uuid4()), 'channel_id': item_channel_id, 'type': item['type'],
+                'file_id': item['file_id'], 'file_unique_id': item.get('file_unique_id'), 'caption': item.get('caption'),
+                'priority': priority,
+            })
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                await insert_posts(batch)
+                imported += len(batch)
+                batch = []
+                logger.info("Импортировано постов: %d.", imported)
+        if batch:
+            await insert_posts(batch)
+            imported += len(batch)
+    finally:
+        if bot is not None:
+            await uploader.stop()
+            await bot.shutdown()
+    if imported:
+        await save_bot_state(QUEUE_REVISION_KEY, str(uuid.uuid4()))
+    return imported
+
+
+async def export_queue(destination: str, channel_id: str | None = None) -> int:
+    """Выгружает очередь в JSONL постранично, не держа ее целиком в памяти."""
+    exported, last_key = 0, ('', 0)
+    priority_names = {value: name for name, value in PRIORITIES.items()}
+    with open(destination, 'w', encoding='utf-8') as f:
+        while True:
+            if channel_id:
+                rows = await db.fetchall(
+                    f"SELECT {POST_COLUMNS}, position FROM meme_queue WHERE channel_id = ? AND position > ? "
+                    "ORDER BY position LIMIT ?", (channel_id, last_key[1], EXPORT_PAGE_SIZE), row_factory=dict_row
+                )
+            else:
+                rows = await db.fetchall(
+                    f"SELECT {POST_COLUMNS}, position FROM meme_queue WHERE (channel_id, position) > (?, ?) "
+                    "ORDER BY channel_id, position LIMIT ?", (*last_key, EXPORT_PAGE_SIZE), row_factory=dict_row
+                )
+            if not rows:
+                return exported
+            for post_data in rows:
+                last_key = (post_data['channel_id'], post_data.pop('position'))
+                post_data['priority'] = priority_names.get(post_data['priority'], post_data['priority'])
+                f.write(json.dumps(post_data, ensure_ascii=False) + "\n")
+            exported += len(rows)
+
+
+async def run_queue_command(args) -> None:
+    # Только схема: загружать всю очередь в память, как при старте бота, CLI не нужно.
+    await db.run(_setup_schema)
+    try:
+        if args.command == 'import':
+            count = await import_queue(args.source, args.channel, args.upload_chat)
+            print(f"Импортировано постов: {count}. Запущенный бот перепланирует очередь в течение "
+                  f"{QUEUE_REVISION_CHECK_INTERVAL} с.")
+        else:
+            count = await export_queue(args.destination, args.channel)
+            print(f"Выгружено постов: {count}.")
+    finally:
+        await db.close()
+
+
+def queue_cli(argv: list[str]) -> None:
+    """python main.py import <файл.jsonl|каталог> | python main.py export <файл.jsonl>"""
+    parser = argparse.ArgumentParser(prog="main.py", description="Массовый импорт и экспорт очереди мемов.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help="Добавить посты из JSONL или каталога с медиа")
+    import_parser.add_argument('source')
+    import_parser.add_argument('--channel', default=CHANNELS[0].chat_id if CHANNELS else None,
+                               help="Канал для записей без channel_id (по умолчанию первый из CHANNELS)")
+    import_parser.add_argument('--upload-chat', default=ALLOWED_USER_IDS[0] if ALLOWED_USER_IDS else None,
+                               help="Чат для загрузки локальных файлов (по умолчанию первый администратор)")
+    export_parser = subparsers.add_parser('export', help="Выгрузить очередь в JSONL")
+    export_parser.add_argument('destination')
+    export_parser.add_argument('--channel', help="Выгрузить только этот канал")
+    asyncio.run(run_queue_command(parser.parse_args(argv)))
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        queue_cli(sys.argv[1:])
+    else:
+        main()
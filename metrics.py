@@ -0,0 +1,157 @@
+import asyncio
+import functools
+import logging
+import re
+import time
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Убирает из имени задачи ID поста или пользователя, чтобы не плодить метки.
+_JOB_SUFFIX_RE = re.compile(r'_(?:[0-9a-f]{8}-[0-9a-f-]{27}|-?\d+)$')
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе бакета."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return self.max
+
+
+class Metrics:
+    """Счетчики и гистограммы в памяти процесса с выводом в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self.histograms: dict[tuple[str, str, str], Histogram] = {}
+        self.counters: dict[tuple[str, str, str], int] = {}
+        self._scheduled_runs: dict[str, datetime] = {}
+
+    def observe(self, metric: str, label: str, name: str, value: float) -> None:
+        key = (metric, label, name)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, metric: str, label: str, name: str, amount: int = 1) -> None:
+        key = (metric, label, name)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def render(self) -> str:
+        lines = []
+        for (metric, label, name), histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{{label}="{name}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{metric}_sum{{{label}="{name}"}} {histogram.sum:.6f}')
+            lines.append(f'{metric}_count{{{label}="{name}"}} {histogram.count}')
+        for (metric, label, name), value in sorted(self.counters.items()):
+            lines.append(f'{metric}{{{label}="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    # --- Задержка запуска задач JobQueue ---
+
+    def watch_job_lag(self, scheduler) -> None:
+        """Запоминает плановое время каждого запуска, чтобы обертка задачи посчитала опоздание."""
+        from apscheduler.events import EVENT_JOB_SUBMITTED
+
+        def on_submitted(event):
+            if event.scheduled_run_times:
+                self._scheduled_runs[event.job_id] = event.scheduled_run_times[-1]
+
+        scheduler.add_listener(on_submitted, EVENT_JOB_SUBMITTED)
+
+    def pop_job_lag(self, job) -> float | None:
+        scheduled = self._scheduled_runs.pop(job.job.id, None)
+        if scheduled is None:
+            return None
+        return (datetime.now(timezone.utc) - scheduled).total_seconds()
+
+
+metrics = Metrics()
+
+
+def job_label(job_name: str | None) -> str:
+    return _JOB_SUFFIX_RE.sub('', job_name) if job_name else "unnamed"
+
+
+def instrumented(kind: str):
+    """Декоратор корутины: длительность, ошибки и (для задач) опоздание относительно расписания."""
+    def decorator(func):
+        name = func.__name__
+        metric = f"bot_{kind}_duration_seconds"
+        errors_metric = f"bot_{kind}_errors_total"
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if kind == 'job':
+                job = getattr(args[0], 'job', None) if args else None
+                lag = metrics.pop_job_lag(job) if job is not None else None
+                if lag is not None:
+                    metrics.observe("bot_job_lag_seconds", "job", job_label(job.name), max(0.0, lag))
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                metrics.inc(errors_metric, kind, name)
+                raise
+            finally:
+                duration = time.perf_counter() - started
+                metrics.observe(metric, kind, name, duration)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("%s %s выполнен за %.1f мс", kind, name, duration * 1000,
+                                 extra={'job': name, 'duration_ms': round(duration * 1000, 3)})
+        return wrapper
+    return decorator
+
+
+async def _handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        path = request_line.split()[1].decode() if len(request_line.split()) > 1 else "/"
+        if path.split('?')[0] == "/metrics":
+            body, status = metrics.render().encode(), "200 OK"
+        else:
+            body, status = b"Not Found\n", "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str, port: int) -> asyncio.AbstractServer:
+    """Поднимает локальный HTTP-эндпоинт /metrics в формате Prometheus."""
+    server = await asyncio.start_server(_handle_metrics_request, host, port)
+    logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import random
+import time
+from datetime import timedelta
+
+import httpx
+from telegram import InputMediaPhoto, InputMediaVideo
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+logger = logging.getLogger(__name__)
+
+# Тип медиа -> (метод Bot, имя аргумента с file_id)
+SEND_METHODS = {
+    'photo': ('send_photo', 'photo'),
+    'video': ('send_video', 'video'),
+    'animation': ('send_animation', 'animation'),
+}
+# Типы, которые Telegram принимает в одном send_media_group: фото и видео смешивать можно, анимации - нет.
+ALBUM_MEDIA = {
+    'photo': InputMediaPhoto,
+    'video': InputMediaVideo,
+}
+ALBUM_MAX_SIZE = 10
+
+
+async def send_media(bot, chat_id, post_data: dict, **kwargs):
+    """Отправляет пост нужным методом Bot в зависимости от типа медиа."""
+    method_name, media_arg = SEND_METHODS[post_data['type']]
+    kwargs.setdefault('caption', post_data.get('caption'))
+    return await getattr(bot, method_name)(chat_id=chat_id, **{media_arg: post_data['file_id']}, **kwargs)
+
+
+async def send_album(bot, chat_id, posts: list[dict], **kwargs):
+    """Отправляет посты одним альбомом; подпись каждого поста остается под его медиа."""
+    media = [ALBUM_MEDIA[post['type']](media=post['file_id'], caption=post.get('caption')) for post in posts]
+    return await bot.send_media_group(chat_id=chat_id, media=media, **kwargs)
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+def maybe_delivered(error: Exception) -> bool:
+    """Мог ли запрос дойти до Telegram: TimedOut при ожидании пула или подключения означает, что он не отправлялся."""
+    return isinstance(error, TimedOut) and not isinstance(error.__cause__, (httpx.PoolTimeout, httpx.ConnectTimeout))
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Publisher:
+    """Очередь публикаций: у каждого чата свой воркер, лимит частоты и повторы с экспоненциальной задержкой."""
+
+    def __init__(self, posts_per_minute: float = 20, burst: int = 3, max_retries: int = 5,
+                 base_delay: float = 1.0, max_delay: float = 60.0):
+        self.posts_per_minute = posts_per_minute
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bot = None
+        self._queues: dict = {}
+        self._workers: dict = {}
+
+    def start(self, bot) -> None:
+        self.bot = bot
+
+    async def stop(self) -> None:
+        for task in self._workers.values():
+            task.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._workers.clear()
+        self._queues.clear()
+
+    async def publish(self, chat_id, post_data: dict, **kwargs):
+        """Ставит пост в очередь чата и ждет результата отправки. Ошибку последней попытки пробрасывает."""
+        return await self._submit(chat_id, send_media, post_data, kwargs)
+
+    async def publish_album(self, chat_id, posts: list[dict], **kwargs):
+        """Как publish(), но отправляет посты одним альбомом: один вызов API и один токен лимита."""
+        return await self._submit(chat_id, send_album, posts, kwargs)
+
+    async def _submit(self, chat_id, send, payload, kwargs: dict):
+        if self.bot is None:
+            raise RuntimeError("Publisher не запущен.")
+        future = asyncio.get_running_loop().create_future()
+        self._queue_for(chat_id).put_nowait((send, payload, kwargs, future))
+        return await future
+
+    def _queue_for(self, chat_id) -> asyncio.Queue:
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = asyncio.Queue()
+            self._workers[chat_id] = asyncio.create_task(self._worker(chat_id, queue))
+        return queue
+
+    async def _worker(self, chat_id, queue: asyncio.Queue) -> None:
+        bucket = TokenBucket(self.posts_per_minute / 60, self.burst)
+        while True:
+            send, payload, kwargs, future = await queue.get()
+            try:
+                if future.done():
+                    continue
+                await bucket.acquire()
+                message = await self._send_with_retry(send, chat_id, payload, kwargs)
+                if not future.done():
+                    future.set_result(message)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                queue.task_done()
+
+    async def _send_with_retry(self, send, chat_id, payload, kwargs: dict):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await send(self.bot, chat_id, payload, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = _retry_after_seconds(e)
+            except BadRequest:
+                raise
+            except NetworkError as e:
+                # Таймаут чтения или записи - тоже NetworkError, но запрос мог дойти до Telegram и повтор
+                # продублирует пост. Повторяем только ошибки, при которых сообщение точно не отправлено.
+                if maybe_delivered(e) or attempt == self.max_retries:
+                    raise
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.8, 1.2)
+            logger.warning("Повтор отправки в %s через %.1f с (попытка %d).", chat_id, delay, attempt + 1)
+            await asyncio.sleep(delay)
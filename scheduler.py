@@ -0,0 +1,153 @@
+import logging
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+from apscheduler.jobstores.base import JobLookupError
+
+logger = logging.getLogger(__name__)
+
+JOB_PREFIX = "normal_post_job_"
+# Меньшее значение публикуется раньше; внутри одного приоритета - в порядке добавления.
+PRIORITIES = {'urgent': 0, 'normal': 1, 'filler': 2}
+DEFAULT_PRIORITY = PRIORITIES['normal']
+
+
+def slot_interval(window: timedelta, max_posts: int, min_spacing: timedelta) -> timedelta:
+    """Шаг сетки для окна длиной window."""
+    return max(min_spacing, window / max_posts)
+
+
+def daily_slots(start: datetime, end: datetime, max_posts: int, min_spacing: timedelta) -> list[datetime]:
+    """Фиксированная сетка окна (start, end): не больше max_posts слотов и не чаще min_spacing."""
+    if max_posts <= 0 or start >= end:
+        return []
+    interval = slot_interval(end - start, max_posts, min_spacing)
+    slots = []
+    when = start + interval / 2
+    while when < end and len(slots) < max_posts:
+        slots.append(when)
+        when += interval
+    return slots
+
+
+def plan_slots(count: int, windows, earliest: datetime, max_posts: int, min_spacing: timedelta) -> list[datetime]:
+    """Первые count слотов сетки не раньше earliest; windows - окна (start, end) по дням подряд."""
+    slots = []
+    if count <= 0:
+        return slots
+    for start, end in windows:
+        for when in daily_slots(start, end, max_posts, min_spacing):
+            if when < earliest:
+                continue
+            slots.append(when)
+            if len(slots) == count:
+                return slots
+    return slots
+
+
+class QueueOrder:
+    """Очередь канала в порядке публикации по ключу (приоритет, позиция): вставка и удаление - бинарный поиск."""
+
+    def __init__(self, entries=()):
+        self._keys = sorted((priority, position, post_id) for post_id, priority, position in entries)
+        self._by_id = {key[2]: key for key in self._keys}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, post_id: str) -> bool:
+        return post_id in self._by_id
+
+    def add(self, post_id: str, priority: int, position: int) -> int:
+        """Вставляет пост и возвращает его место в очереди; посты перед ним не сдвигаются."""
+        self.remove(post_id)
+        key = (priority, position, post_id)
+        index = bisect_left(self._keys, key)
+        self._keys.insert(index, key)
+        self._by_id[post_id] = key
+        return index
+
+    def remove(self, post_id: str) -> int | None:
+        key = self._by_id.pop(post_id, None)
+        if key is None:
+            return None
+        index = bisect_left(self._keys, key)
+        del self._keys[index]
+        return index
+
+    def index(self, post_id: str) -> int | None:
+        key = self._by_id.get(post_id)
+        return bisect_left(self._keys, key) if key else None
+
+    def ids(self, start: int = 0, stop: int | None = None) -> list[str]:
+        return [key[2] for key in self._keys[start:stop]]
+
+
+class PlanDiff(NamedTuple):
+    added: dict[str, datetime]
+    moved: dict[str, datetime]
+    removed: list[str]
+
+
+class PostScheduler:
+    """План публикаций обычных постов одного канала, который применяется к JobQueue только по разнице."""
+
+    def __init__(self, callback, channel_id: str, job_kwargs: dict | None = None,
+                 tolerance: timedelta = timedelta(minutes=2)):
+        self.callback = callback
+        self.channel_id = channel_id
+        self.job_kwargs = job_kwargs or {}
+        self.tolerance = tolerance
+        self.plan: dict[str, datetime] = {}
+        self._jobs: dict = {}
+
+    def apply(self, job_queue, new_plan: dict[str, datetime], tolerance: timedelta | None = None) -> PlanDiff:
+        """Добавляет, переносит и удаляет только изменившиеся задачи."""
+        tolerance = self.tolerance if tolerance is None else tolerance
+        self._drop_missed(job_queue)
+        diff = PlanDiff({}, {}, [])
+        for post_id in self.plan.keys() - new_plan.keys():
+            self._jobs.pop(post_id).schedule_removal()
+            del self.plan[post_id]
+            diff.removed.append(post_id)
+        for post_id, when in new_plan.items():
+            old_time = self.plan.get(post_id)
+            if old_time is None:
+                self._jobs[post_id] = job_queue.run_once(
+                    self.callback, when=when, data={'channel_id': self.channel_id, 'post_id': post_id},
+                    name=f"{JOB_PREFIX}{post_id}", job_kwargs=self.job_kwargs
+                )
+                diff.added[post_id] = when
+            elif abs(when - old_time) > tolerance:
+                self._jobs[post_id].job.reschedule(trigger='date', run_date=when)
+                diff.moved[post_id] = when
+            else:
+                continue
+            self.plan[post_id] = when
+            logger.debug("Пост %s запланирован на %s", post_id, when, extra={'post_id': post_id})
+        return diff
+
+    def _drop_missed(self, job_queue) -> None:
+        # Задачу, опоздавшую больше misfire_grace_time, APScheduler удаляет без вызова callback (и forget):
+        # такие посты убираются из плана и ставятся заново как новые.
+        for post_id, job in list(self._jobs.items()):
+            if job_queue.scheduler.get_job(job.job.id) is None:
+                logger.warning("Задача поста %s пропущена планировщиком, пост будет запланирован заново.", post_id,
+                               extra={'post_id': post_id})
+                self.forget(post_id)
+
+    def clear(self) -> None:
+        """Снимает все задачи плана, например когда реплика перестала быть лидером."""
+        for job in self._jobs.values():
+            try:
+                job.schedule_removal()
+            except JobLookupError:
+                pass
+        self._jobs.clear()
+        self.plan.clear()
+
+    def forget(self, post_id: str) -> None:
+        """Убирает из плана пост, задача которого уже сработала."""
+        self.plan.pop(post_id, None)
+        self._jobs.pop(post_id, None)
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Настройки соединения: WAL позволяет читать во время записи, а synchronous=NORMAL
+# в режиме WAL не делает fsync на каждый коммит.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",
+)
+
+
+def dict_row(cursor: sqlite3.Cursor, row: tuple) -> dict:
+    """row_factory, возвращающая строку как dict по именам колонок."""
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+def _cursor(conn: sqlite3.Connection, row_factory=None) -> sqlite3.Cursor:
+    cursor = conn.cursor()
+    cursor.row_factory = row_factory
+    return cursor
+
+
+class Storage:
+    """Долгоживущее соединение с SQLite, все запросы выполняются в отдельном потоке."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        # Один поток: соединение никогда не используется параллельно, а запросы идут строго по очереди.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            self._conn = conn
+            logger.info("Открыто соединение с БД %s (WAL).", self.path)
+        return self._conn
+
+    def _call(self, func, *args):
+        conn = self._connect()
+        with conn:
+            return func(conn, *args)
+
+    def _call_immediate(self, func, *args):
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            return func(conn, *args)
+
+    async def run(self, func, *args):
+        """Выполняет func(conn, *args) в потоке БД внутри одной транзакции."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, func, *args)
+
+    async def run_immediate(self, func, *args):
+        """Как run(), но транзакция сразу берет блокировку записи (BEGIN IMMEDIATE).
+
+        Нужно, когда func сначала читает, а потом пишет на основе прочитанного: обычная транзакция
+        начинается только с первого INSERT/UPDATE, и другой процесс может успеть записать между ними.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call_immediate, func, *args)
+
+    async def execute(self, sql: str, params=()) -> int:
+        return await self.run(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql: str, seq_of_params) -> int:
+        return await self.run(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    async def fetchone(self, sql: str, params=(), row_factory=None):
+        return await self.run(lambda conn: _cursor(conn, row_factory).execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params=(), row_factory=None) -> list:
+        return await self.run(lambda conn: _cursor(conn, row_factory).execute(sql, params).fetchall())
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+        """Закрывает соединение и останавливает поток БД."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._close)
+        self._executor.shutdown(wait=True)
+
+
+def apply_migrations(conn: sqlite3.Connection, migrations) -> None:
+    """Применяет миграции с номером больше PRAGMA user_version, каждую в отдельной транзакции."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(migrations[version:], start=version + 1):
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        migration(conn)
+        conn.execute(f"PRAGMA user_version = {number}")
+        conn.commit()
+        logger.info("Применена миграция БД №%s: %s.", number, migration.__name__)
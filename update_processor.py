@@ -0,0 +1,56 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+def user_key(update: object) -> Hashable | None:
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обновления разных пользователей обрабатываются параллельно, одного пользователя - строго по очереди.
+
+    key(update) определяет очередь обновления; None - обновление ни с кем не сериализуется.
+    """
+
+    __slots__ = ('_key', '_locks', '_waiting')
+
+    def __init__(self, max_concurrent_updates: int, key: Callable[[object], Hashable | None] = user_key):
+        super().__init__(max_concurrent_updates)
+        self._key = key
+        self._locks: dict[Hashable, asyncio.Lock] = {}
+        self._waiting: dict[Hashable, int] = {}
+
+    async def process_update(self, update: object, coroutine: Awaitable) -> None:
+        key = self._key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        # Сначала очередь пользователя, потом общий семафор: ожидающие обновления одного
+        # пользователя не занимают слоты, нужные остальным.
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass